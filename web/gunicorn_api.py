@@ -0,0 +1,18 @@
+# gunicorn 配置: 采集 API (/hq/api/) 专用的 gevent worker, 与页面的同步 worker 分开,
+# 上传缓慢或大量上传的 agent 只占用协程, 不会占满页面的 worker
+# gunicorn -c gunicorn_api.py ujscert.wsgi:application
+
+bind = '0.0.0.0:8001'
+workers = 2
+worker_class = 'gevent'
+worker_connections = 200  # 每个 worker 同时处理的请求 (含正在上传的), 写库并发由 INGEST_WORKERS 限制
+timeout = 120
+loglevel = 'info'
+errorlog = '/var/log/gunicorn/api.log'
+accesslog = '/var/log/gunicorn/api-access.log'
+
+
+def post_fork(server, worker):
+    # psycopg2 等待数据库时让出协程
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -0,0 +1,339 @@
+"""
+Caching shared by the apps.
+
+TieredCache is the default cache backend: a small per-process LRU in front of a cache every process shares, so hot
+keys (data versions, the navigation bar, leaderboards) are read without leaving the process.
+cache_aside() caches what a function reads from the database until one of the models it reads changes.
+"""
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from functools import lru_cache, wraps
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+MODEL_VERSION_KEY = 'model:version:%s'  # per model label, part of the key of every cache_aside value reading it
+METRICS_KEY = 'metrics:%s:%s'  # per group and counter
+
+
+class LRUCache(object):
+    """
+    Small thread-safe in-process cache, least recently used entries are evicted beyond `maxsize`
+    and entries expire `ttl` seconds after being set. Counts hits and misses.
+    """
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+def add_to_counter(key, n=1):
+    """add `n` to a counter in the default cache, creating it if needed"""
+    try:
+        cache.incr(key, n)
+    except ValueError:
+        if not cache.add(key, n, None):
+            cache.incr(key, n)
+
+
+class Metrics(object):
+    """
+    Groups of counters, e.g. the hits and misses of a cache. They are summed in the process and added to counters in
+    the default cache at most every CACHE_METRICS_INTERVAL seconds, so every process reports into the same totals
+    without a cache write per hit. Registered groups are the hit/miss groups of report().
+    """
+
+    def __init__(self):
+        self.groups = OrderedDict()  # registered group -> its counters, in report order
+        self._counts = Counter()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def register(self, group, counters):
+        self.groups[group] = counters
+
+    def add(self, group, counter, n=1):
+        with self._lock:
+            self._counts[group, counter] += n
+            due = time.monotonic() - self._flushed >= getattr(settings, 'CACHE_METRICS_INTERVAL', 10)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._flushed = time.monotonic()
+        for (group, counter), n in counts.items():
+            add_to_counter(METRICS_KEY % (group, counter), n)
+
+    def totals(self, groups):
+        """{group: {counter: total of every process}} of `groups`, a dict of group -> counters"""
+        self.flush()
+        keys = [METRICS_KEY % (group, counter) for group, counters in groups.items() for counter in counters]
+        values = cache.get_many(keys)
+        return {group: {counter: values.get(METRICS_KEY % (group, counter), 0) for counter in counters}
+                for group, counters in groups.items()}
+
+    def report(self):
+        """totals of every process in the registered groups, with the hit rate of each group"""
+        totals_by_group = self.totals(self.groups)
+
+        report = OrderedDict()
+        for group in self.groups:
+            totals = totals_by_group[group]
+            misses = totals.get('misses', 0)
+            requests = sum(totals.values())
+            totals['hit_rate'] = (requests - misses) / requests if requests else 0
+            report[group] = totals
+        return report
+
+
+metrics = Metrics()
+
+# the LRUCache of each TieredCache, by LOCATION and shared alias. django.core.cache.caches makes a backend per thread
+# (per greenlet under gevent), so like LocMemCache the data lives at module level for the threads to share.
+_local_caches = {}
+_local_caches_lock = threading.Lock()
+
+
+class TieredCache(BaseCache):
+    """
+    Cache backend reading through a per-process LRUCache to another configured cache. OPTIONS:
+    SHARED, the alias of that cache; LOCAL_MAX_ENTRIES; LOCAL_TIMEOUT, seconds a value is served from the process.
+    Backends with the same LOCATION and SHARED alias, in any thread of the process, use the same LRUCache.
+    Writes go to the shared cache and replace the local copy, other processes see them within LOCAL_TIMEOUT.
+    Local values are kept pickled, like LocMemCache does, so callers can't change each other's copies.
+    """
+    missing = object()
+
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = options.get('SHARED', 'shared')
+        with _local_caches_lock:
+            name = (location, self.shared_alias)
+            if name not in _local_caches:
+                _local_caches[name] = LRUCache(options.get('LOCAL_MAX_ENTRIES', 1000), options.get('LOCAL_TIMEOUT', 5))
+            self.local = _local_caches[name]
+        metrics.register('tiered', ('local_hits', 'shared_hits', 'misses'))
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    def _keep(self, key, value, timeout, version):
+        key = self.make_key(key, version)
+        if timeout == 0:
+            self.local.delete(key)
+        else:
+            self.local.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _forget(self, key, version):
+        self.local.delete(self.make_key(key, version))
+
+    def get(self, key, default=None, version=None):
+        pickled = self.local.get(self.make_key(key, version), self.missing)
+        if pickled is not self.missing:
+            metrics.add('tiered', 'local_hits')
+            return pickle.loads(pickled)
+
+        value = self.shared.get(key, self.missing, version)
+        if value is self.missing:
+            metrics.add('tiered', 'misses')
+            return default
+
+        metrics.add('tiered', 'shared_hits')
+        self._keep(key, value, None, version)
+        return value
+
+    def get_many(self, keys, version=None):
+        found, remote = {}, []
+        for key in keys:
+            pickled = self.local.get(self.make_key(key, version), self.missing)
+            if pickled is self.missing:
+                remote.append(key)
+            else:
+                found[key] = pickle.loads(pickled)
+
+        fetched = self.shared.get_many(remote, version) if remote else {}
+        for key, value in fetched.items():
+            self._keep(key, value, None, version)
+        found.update(fetched)
+
+        metrics.add('tiered', 'local_hits', len(keys) - len(remote))
+        metrics.add('tiered', 'shared_hits', len(fetched))
+        metrics.add('tiered', 'misses', len(remote) - len(fetched))
+        return found
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version)
+        if added:
+            self._keep(key, value, timeout, version)
+        else:
+            self._forget(key, version)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version)
+        self._keep(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version)
+        for key, value in data.items():
+            self._keep(key, value, timeout, version)
+        return failed
+
+    def delete(self, key, version=None):
+        self.shared.delete(key, version)
+        self._forget(key, version)
+
+    def delete_many(self, keys, version=None):
+        self.shared.delete_many(keys, version)
+        for key in keys:
+            self._forget(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        self._forget(key, version)
+        return self.shared.incr(key, delta, version)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+
+
+def invalidate(func):
+    # run now, and again once committed in case a reader re-cached the old value meanwhile
+    func()
+    transaction.on_commit(func)
+
+
+def stored_version(key):
+    """
+    The version kept under `key` in the default cache, starting a new one if there is none.
+    Not cache.get_or_set(): on Django 1.9 it returns False when another process adds the key first.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def model_version_key(model):
+    return MODEL_VERSION_KEY % model._meta.label_lower
+
+
+def model_versions(*models):
+    keys = [model_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    return [versions.get(key) or stored_version(key) for key in keys]
+
+
+def invalidate_models(*models):
+    """
+    Move models to new versions, dropping every cache_aside value that reads them.
+    Saving or deleting an instance does this by itself; writes that send no signal (raw SQL, QuerySet.update(),
+    bulk_create()) call it.
+    """
+    keys = [model_version_key(model) for model in models]
+    invalidate(lambda: cache.delete_many(keys))
+
+
+@lru_cache()
+def watched_models():
+    return tuple(apps.get_model(label) for label in getattr(settings, 'CACHE_ASIDE_MODELS', ()))
+
+
+def model_changed(sender, **kwargs):
+    # issubclass: child models of multi-table inheritance and the classes of deferred (only()/defer()) instances
+    # send their own class, not the one given to cache_aside
+    changed = [model for model in watched_models() if issubclass(sender, model)]
+    if changed:
+        invalidate_models(*changed)
+
+
+post_save.connect(model_changed, dispatch_uid='ujscert.cache.model_changed')
+post_delete.connect(model_changed, dispatch_uid='ujscert.cache.model_changed')
+
+
+def cache_aside(*models, timeout=DEFAULT_TIMEOUT):
+    """
+    Cache what the decorated function returns until any of `models` changes, or for `timeout` seconds.
+    The key is made of the function, the repr of its arguments and the current versions of the models, so arguments
+    must be plain values; return plain values too, e.g. list(queryset) rather than the queryset.
+    Hits and misses are counted under the function's name, see metrics.report().
+    The models must be listed in CACHE_ASIDE_MODELS, whose changes every process signals whether or not it
+    imported the function. Other processes may serve the old value until their local copy of the model versions
+    expires, LOCAL_TIMEOUT seconds at most.
+    """
+    unwatched = [model._meta.label for model in models
+                 if model._meta.label not in getattr(settings, 'CACHE_ASIDE_MODELS', ())]
+    if unwatched:
+        raise ImproperlyConfigured('cache_aside: add %s to CACHE_ASIDE_MODELS' % ', '.join(unwatched))
+
+    def decorator(func):
+        name = '%s.%s' % (func.__module__, func.__qualname__)
+        metrics.register(name, ('hits', 'misses'))
+
+        @wraps(func)
+        def wrapper(*args):
+            data = repr((name, args, model_versions(*models)))
+            key = 'aside:%s' % hashlib.md5(data.encode('utf8')).hexdigest()
+            entry = cache.get(key)  # a 1-tuple, so that None can be cached
+            if entry is None:
+                metrics.add(name, 'misses')
+                entry = (func(*args),)
+                cache.set(key, entry, timeout)
+            else:
+                metrics.add(name, 'hits')
+            return entry[0]
+
+        wrapper.invalidate = lambda: invalidate_models(*models)
+        return wrapper
+
+    return decorator
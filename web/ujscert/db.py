@@ -0,0 +1,80 @@
+"""
+Persistent database connections.
+
+Django keeps a connection open across requests for CONN_MAX_AGE seconds (its maximum lifetime) and closes it
+on request_started / request_finished once it is older. A connection kept that long can be dropped by the server
+or a pooler in between, so before a request reuses one that was idle for DB_HEALTH_CHECK_INTERVAL seconds it is
+pinged and reopened if dead, instead of failing the request. Connections opened and reused are counted per process.
+"""
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+CONNECTION_STATS = ('connects', 'reuses', 'health_checks', 'unusable')
+
+stats = Counter()  # (alias, stat) -> count, for this process
+stats_lock = threading.Lock()
+
+
+def count(alias, stat):
+    with stats_lock:
+        stats[alias, stat] += 1
+
+
+def connection_opened(sender, connection, **kwargs):
+    connection.opened_at = connection.checked_at = time.monotonic()
+    count(connection.alias, 'connects')
+
+
+def check_connections(**kwargs):
+    """runs after close_old_connections, which already closed the connections past CONN_MAX_AGE"""
+    interval = getattr(settings, 'DB_HEALTH_CHECK_INTERVAL', 10)
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+
+        count(connection.alias, 'reuses')
+        if interval is None or now - getattr(connection, 'checked_at', now) < interval:
+            continue
+
+        count(connection.alias, 'health_checks')
+        connection.checked_at = now
+        if not connection.is_usable():
+            count(connection.alias, 'unusable')
+            connection.close()
+
+
+connection_created.connect(connection_opened, dispatch_uid='ujscert.db.connection_opened')
+request_started.connect(check_connections, dispatch_uid='ujscert.db.check_connections')
+
+
+def connection_stats():
+    """this process's counters and the age of its open connections, per database alias"""
+    now = time.monotonic()
+    report = {'pid': os.getpid()}
+    for alias in connections:
+        connection = connections[alias]
+        with stats_lock:
+            report[alias] = {stat: stats[alias, stat] for stat in CONNECTION_STATS}
+        opened_at = getattr(connection, 'opened_at', None) if connection.connection is not None else None
+        report[alias].update({
+            'max_age': connection.settings_dict['CONN_MAX_AGE'],
+            'open': connection.connection is not None,
+            'age': round(now - opened_at, 1) if opened_at is not None else None,
+        })
+    return report
+
+
+def server_connections(alias='default'):
+    """backends the server runs for our database, by state; behind a pooler this is the pool, not the clients"""
+    with connections[alias].cursor() as cursor:
+        cursor.execute('''SELECT coalesce(state, 'unknown'), count(*) FROM pg_stat_activity
+                          WHERE datname = current_database() GROUP BY 1 ORDER BY 1''')
+        return dict(cursor.fetchall())
@@ -1,12 +1,18 @@
 from django.contrib import admin
 
-from ujscert.headquarter.models import Agent, Fingerprint, Website, Alert
+from ujscert.headquarter.models import Agent, Fingerprint, Website, Alert, Property
 
 
 class AgentAdmin(admin.ModelAdmin):
     readonly_fields = ('x509_cert', 'x509_key')
 
+
+class PropertyAdmin(admin.ModelAdmin):
+    list_display = ('name', 'network', 'department')
+    search_fields = ('name', 'department')
+
 admin.site.register(Agent, AgentAdmin)
+admin.site.register(Property, PropertyAdmin)
 admin.site.register(Fingerprint)
 admin.site.register(Website)
 admin.site.register(Alert)
@@ -0,0 +1,329 @@
+import hashlib
+from ipaddress import ip_address
+
+import ujson
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ujscert.cache import invalidate_models
+from ujscert.headquarter.matcher import inventory, cpe_product
+from ujscert.headquarter.models import Website, WebsiteChange, App, Fingerprint, Alert, PageBlob, refresh_hosts, \
+    record_products, record_cpe_products, invalidate_search
+
+WEBSITE_KEYS = ('domain', 'ip', 'port', 'url', 'headers', 'html', 'title')
+
+# rows per INSERT statement, keeps single statements reasonably sized for large html
+INSERT_BATCH_SIZE = 100
+
+
+def reserve_ids(model, count):
+    """take `count` primary keys from the model's sequence in one round-trip"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def error_reason(e):
+    if hasattr(e, 'message_dict'):
+        return '; '.join('%s: %s' % (key, ' '.join(messages)) for key, messages in e.message_dict.items())
+    return str(e)
+
+
+def build_website(item):
+    if not isinstance(item, dict):
+        raise ValidationError('item must be an object')
+
+    kwargs = {key: item[key] for key in WEBSITE_KEYS if item.get(key) is not None}
+    kwargs['raw_headers'] = item.get('rawHeader') or ''
+    kwargs['app_joint'] = '/'.join(item.get('apps', []))
+
+    if not kwargs.get('title'):
+        kwargs['title'] = kwargs.get('url', '')
+
+    website = Website(**kwargs)
+    website.clean_fields(exclude=('id', 'headers', 'page', 'search_index'))
+
+    apps = []
+    for name, app in (item.get('detail') or {}).items():
+        app = App(app=name, ver=app.get('version') or '', versions=app.get('versions') or [])
+        app.clean_fields(exclude=('id', 'website', 'ver', 'versions'))
+        App._meta.get_field('ver').run_validators(app.ver)  # may be empty, but must fit the column
+        apps.append(app)
+
+    website.content_hash = content_hash(website, apps)
+    return website, apps
+
+
+def content_hash(website, apps):
+    """everything a scan reports about a page, a rescan with the same hash changed nothing worth a new version"""
+    content = [website.domain, website.ip, website.port, website.title, website.page_id or '', website.raw_headers,
+               website.headers, website.app_joint, sorted([app.app, app.ver, app.versions] for app in apps)]
+    return hashlib.md5(ujson.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def latest_versions(urls):
+    """url -> (id, content_hash) of the newest stored Website for each of `urls`"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT DISTINCT ON (url) url, id, content_hash FROM headquarter_website '
+                       'WHERE url = ANY(%s) ORDER BY url, id DESC', [list(urls)])
+        return {url: (pk, digest) for url, pk, digest in cursor.fetchall()}
+
+
+def index_websites(items):
+    """
+    Write a batch of scanned pages and their detected apps with bulk inserts in one transaction.
+    A page whose content hash matches the latest stored version of its url only has that version's
+    last_seen bumped, anything else is inserted as a new version and recorded as a WebsiteChange.
+    Returns one result per item, in order: {'status': 'ok', 'id': pk, 'changed': bool}
+    or {'status': 'fail', 'reason': ...}
+    """
+    results = []
+    pages = []
+
+    for item in items:
+        try:
+            website, apps = build_website(item)
+        except (ValidationError, AttributeError, TypeError) as e:
+            results.append({'status': 'fail', 'reason': error_reason(e)})
+            continue
+
+        results.append({'status': 'ok'})
+        pages.append((website, apps, results[-1]))
+
+    if not pages:
+        return results
+
+    with transaction.atomic():
+        latest = latest_versions({website.url for website, _, _ in pages})
+        seen = []
+        changed = []
+        for website, website_apps, result in pages:
+            pk, digest = latest.get(website.url, (None, None))
+            if digest == website.content_hash:
+                result.update(id=pk, changed=False)
+                if pk is not None:  # None: a duplicate of a page written by this batch, filled in below
+                    seen.append(pk)
+                continue
+
+            changed.append((website, website_apps, result, pk))
+            latest[website.url] = (None, website.content_hash)  # later duplicates in this batch are unchanged
+
+        if seen:
+            Website.objects.filter(pk__in=seen).update(last_seen=timezone.now())
+        record_products(app.app for _, website_apps, _ in pages for app in website_apps)
+        if not changed:
+            return results
+
+        ids = reserve_ids(Website, len(changed))
+        apps = []
+        events = []
+        for pk, (website, website_apps, result, previous) in zip(ids, changed):
+            website.pk = result['id'] = pk
+            result['changed'] = True
+            latest[website.url] = (pk, website.content_hash)
+            if previous is not None:
+                events.append(WebsiteChange(url=website.url, website_id=pk, previous_id=previous))
+            for app in website_apps:
+                app.website_id = pk
+                apps.append(app)
+
+        for website, website_apps, result in pages:  # duplicates point at the version written for them
+            if result['id'] is None:
+                result['id'] = latest[website.url][0]
+
+        PageBlob.objects.store(website.page for website, _, _, _ in changed if website.page_id)
+        Website.objects.bulk_create([website for website, _, _, _ in changed], batch_size=INSERT_BATCH_SIZE)
+        App.objects.bulk_create(apps, batch_size=INSERT_BATCH_SIZE * 8)
+        WebsiteChange.objects.bulk_create(events, batch_size=INSERT_BATCH_SIZE * 8)
+        Website.objects.sync_search_field(ids)
+        invalidate_search('web')
+    inventory.add(app.app for app in apps)
+
+    return results
+
+
+def build_fingerprint(item):
+    if not isinstance(item, dict):
+        raise ValidationError('item must be an object')
+
+    fingerprint = Fingerprint(**item)
+    # banner and raw may be empty, as they always could
+    fingerprint.clean_fields(exclude=('id', 'cpes', 'certificate', 'banner', 'raw', 'search_index'))
+    # cpes may be empty too, but one that is not a list of strings would fail the whole batch's INSERT
+    if not isinstance(fingerprint.cpes, list) or not all(isinstance(cpe, str) for cpe in fingerprint.cpes):
+        raise ValidationError({'cpes': ['must be a list of strings']})
+    cpe_field = Fingerprint._meta.get_field('cpes').base_field
+    try:
+        for cpe in fingerprint.cpes:
+            cpe_field.clean(cpe, fingerprint)
+    except ValidationError as e:
+        raise ValidationError({'cpes': e.messages})
+    return fingerprint
+
+
+def upsert_sql(fields, rows, history):
+    """
+    INSERT ... ON CONFLICT (ip, port) DO UPDATE for `rows` rows, rescans replace the row in place.
+    With `history`, a data-modifying CTE copies the rows about to be replaced into FingerprintHistory,
+    it reads the same snapshot so it sees them as they were before this statement.
+    """
+    qn = connection.ops.quote_name
+    table = qn(Fingerprint._meta.db_table)
+    columns = ', '.join(qn(field.column) for field in fields)
+    row = '(%s)' % ', '.join('%%s::%s' % field.db_type(connection) for field in fields)
+    updates = ', '.join('%s = EXCLUDED.%s' % (qn(field.column), qn(field.column))
+                        for field in fields if field.name not in ('ip', 'port', 'search_index'))
+
+    sql = 'WITH data (%s) AS (VALUES %s) ' % (columns, ', '.join([row] * rows))
+    if history:
+        sql += (', history AS (INSERT INTO headquarter_fingerprinthistory (ip, port, service, product, version, seen) '
+                'SELECT f.ip, f.port, f.service, f.product, f.version, f.timestamp FROM %s f '
+                'JOIN data d ON f.ip = d.ip AND f.port = d.port) ' % table)
+    sql += 'INSERT INTO %s (%s) SELECT * FROM data ON CONFLICT (ip, port) DO UPDATE SET %s RETURNING id, ip, port' % (
+        table, columns, updates)
+    return sql
+
+
+def upsert_fingerprints(items):
+    """
+    Write a batch of fingerprints with one multi-row upsert on (ip, port) per INSERT_BATCH_SIZE items,
+    then refresh the Host summaries of the ips touched.
+    An ip:port seen twice in the batch keeps its last item. Returns one result per item, like index_websites.
+    """
+    results = []
+    latest = {}
+
+    for item in items:
+        try:
+            fingerprint = build_fingerprint(item)
+        except (ValidationError, TypeError) as e:
+            results.append({'status': 'fail', 'reason': error_reason(e)})
+            continue
+
+        fingerprint.timestamp = timezone.now()
+        fingerprint.search_dirty = True
+        results.append({'status': 'ok'})
+        key = (ip_address(fingerprint.ip), fingerprint.port)
+        superseded = latest[key][1] if key in latest else []
+        latest[key] = (fingerprint, superseded + [results[-1]])
+
+    if not latest:
+        return results
+
+    fields = [field for field in Fingerprint._meta.concrete_fields if not field.primary_key]
+    history = getattr(settings, 'FINGERPRINT_HISTORY', True)
+    # in (ip, port) order, so that concurrent batches lock the rows they share in the same order and do not deadlock
+    batch = [latest[key] for key in sorted(latest, key=lambda key: (key[0].version, key))]
+    ids = []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(0, len(batch), INSERT_BATCH_SIZE):
+            chunk = batch[offset:offset + INSERT_BATCH_SIZE]
+            params = [field.get_db_prep_save(getattr(fingerprint, field.attname), connection)
+                      for fingerprint, _ in chunk for field in fields]
+            cursor.execute(upsert_sql(fields, len(chunk), history), params)
+
+            written = {(ip_address(ip), port): pk for pk, ip, port in cursor.fetchall()}
+            for fingerprint, item_results in chunk:
+                pk = written[(ip_address(fingerprint.ip), fingerprint.port)]
+                ids.append(pk)
+                for result in item_results:
+                    result['id'] = pk
+
+        products = [fingerprint.product for fingerprint, _ in batch]
+        cpe_products = {cpe_product(cpe) for fingerprint, _ in batch for cpe in fingerprint.cpes}
+        Fingerprint.objects.sync_search_field(ids)
+        refresh_hosts({fingerprint.ip for fingerprint, _ in batch})
+        record_products(products)
+        record_cpe_products(cpe_products)
+        invalidate_search('host')
+    inventory.add(products)
+    inventory.add(cpe_products)
+
+    return results
+
+
+def build_alert(item):
+    if not isinstance(item, dict):
+        raise ValidationError('item must be an object')
+
+    alert = Alert(**item)
+    alert.clean_fields(exclude=('id',))
+    highlight(alert)
+    return alert
+
+
+def highlight(alert):
+    """add the inventory products `alert` mentions to its keywords, returns whether that changed anything"""
+    matched = inventory.find('%s\n%s' % (alert.title, alert.content))
+    keywords = sorted(set(alert.keywords) | set(matched))
+    highlighted = alert.highlighted or bool(matched)
+    changed = (keywords, highlighted) != (alert.keywords, alert.highlighted)
+    alert.keywords, alert.highlighted = keywords, highlighted
+    return changed
+
+
+def insert_alerts_sql(fields, rows):
+    """
+    INSERT ... ON CONFLICT (url) for `rows` rows, a known advisory only merges in the keywords (and highlighting)
+    of a resend that carries new ones: a sender whose inventory is behind must not drop what match_alerts added.
+    Returns the url of every row written, with whether it is new.
+    """
+    qn = connection.ops.quote_name
+    table = qn(Alert._meta.db_table)
+    columns = ', '.join(qn(field.column) for field in fields)
+    row = '(%s)' % ', '.join('%%s::%s' % field.db_type(connection) for field in fields)
+    return ('INSERT INTO %s AS a (%s) VALUES %s ON CONFLICT (url) DO UPDATE '
+            'SET keywords = ARRAY(SELECT DISTINCT unnest(a.keywords || EXCLUDED.keywords) ORDER BY 1), '
+            'highlighted = a.highlighted OR EXCLUDED.highlighted '
+            'WHERE NOT a.keywords @> EXCLUDED.keywords OR EXCLUDED.highlighted AND NOT a.highlighted '
+            'RETURNING a.url, a.xmax = 0' % (table, columns, ', '.join([row] * rows)))
+
+
+def insert_alerts(items):
+    """
+    Write a batch of feed alerts with one multi-row INSERT ... ON CONFLICT (url) per INSERT_BATCH_SIZE items,
+    so resent advisories cost no failed INSERT and no savepoint. A url seen twice in the batch keeps its last item.
+    Alerts that mention a product of the asset inventory get it in their keywords and are highlighted.
+    Returns (counts, results): counts of new, updated, duplicate and failed items,
+    and one result per item, in order: {'status': 'ok', 'new': bool} or {'status': 'fail', 'reason': ...}
+    """
+    results = []
+    latest = {}
+
+    for item in items:
+        try:
+            alert = build_alert(item)
+        except (ValidationError, TypeError) as e:
+            results.append({'status': 'fail', 'reason': error_reason(e)})
+            continue
+
+        results.append({'status': 'ok', 'new': False})
+        superseded = latest[alert.url][1] if alert.url in latest else []
+        latest[alert.url] = (alert, superseded + [results[-1]])
+
+    counts = {'new': 0, 'updated': 0, 'duplicate': 0, 'failed': len(items) - sum(len(r) for _, r in latest.values())}
+    fields = [field for field in Alert._meta.concrete_fields if not field.primary_key]
+    batch = list(latest.values())
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(0, len(batch), INSERT_BATCH_SIZE):
+            chunk = batch[offset:offset + INSERT_BATCH_SIZE]
+            params = [field.get_db_prep_save(getattr(alert, field.attname), connection)
+                      for alert, _ in chunk for field in fields]
+            cursor.execute(insert_alerts_sql(fields, len(chunk)), params)
+
+            written = dict(cursor.fetchall())
+            for alert, item_results in chunk:
+                outcome = 'duplicate' if alert.url not in written else 'new' if written[alert.url] else 'updated'
+                counts[outcome] += 1
+                counts['duplicate'] += len(item_results) - 1  # later copies of a url repeat the first
+                item_results[0]['new'] = outcome == 'new'
+
+        if counts['new'] or counts['updated']:
+            invalidate_models(Alert)
+
+    return counts, results
@@ -0,0 +1,39 @@
+import time
+import uuid
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+
+from ujscert.headquarter.utils import gen_cert, issue_cert, load_ca, KeyPool
+
+
+class Command(BaseCommand):
+    help = 'Measure certificates/sec of serial, key pool and multi-process issuance. Nothing is written.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=50, help='certificates per measurement')
+        parser.add_argument('--processes', type=int, default=None, help='worker processes (default: CPU count)')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        load_ca()
+
+        self.stdout.write('%-10s %8s %10s' % ('path', 'certs', 'certs/sec'))
+        self.report('serial', count, lambda uids: [issue_cert(uid) for uid in uids])
+
+        pool = KeyPool(count)
+        pool.take()
+        while pool.ready() < count - 1:  # measure signing only, as an agent save sees with a warm pool
+            time.sleep(0.1)
+        self.report('key pool', count - 1, lambda uids: [gen_cert(uid, pool.take()) for uid in uids])
+
+        with Pool(options['processes']) as workers:
+            workers.map(issue_cert, [uuid.uuid4()])  # warm up the workers
+            self.report('parallel', count, lambda uids: workers.map(issue_cert, uids))
+
+    def report(self, name, count, issue):
+        uids = [uuid.uuid4() for _ in range(count)]
+        start = time.time()
+        issue(uids)
+        elapsed = time.time() - start
+        self.stdout.write('%-10s %8d %10.1f' % (name, count, count / elapsed))
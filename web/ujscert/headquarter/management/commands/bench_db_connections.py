@@ -0,0 +1,71 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+from ujscert.db import stats
+
+QUERY = 'SELECT count(*) FROM headquarter_alert WHERE highlighted'
+
+
+class Command(BaseCommand):
+    help = '''Requests/sec of the request cycle (request_started, one small query, request_finished) from concurrent
+    workers, connecting per request and with persistent connections, directly and through a pooler when --pooler
+    is given.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='requests per run (default: 2000)')
+        parser.add_argument('--workers', type=int, default=5, help='concurrent workers, like gunicorn --workers')
+        parser.add_argument('--max-age', type=int, default=60, help='CONN_MAX_AGE of the persistent runs')
+        parser.add_argument('--pooler', metavar='HOST:PORT', help='a pgbouncer in front of the same database')
+
+    def handle(self, *args, **options):
+        targets = [('direct', None)]
+        if options['pooler']:
+            host, _, port = options['pooler'].partition(':')
+            targets.append(('pooler', (host, int(port or 6432))))
+
+        for target, address in targets:
+            for max_age in (0, options['max_age']):
+                alias = 'bench_%s_%d' % (target, max_age)
+                connections.databases[alias] = dict(connections.databases['default'], CONN_MAX_AGE=max_age)
+                if address:
+                    connections.databases[alias].update(HOST=address[0], PORT=address[1])
+                self.run(alias, target, max_age, options['requests'], options['workers'])
+
+    def run(self, alias, target, max_age, requests, workers):
+        latencies = []
+        errors = []
+
+        def work(n):
+            try:
+                for _ in range(n):
+                    start = time.time()
+                    request_started.send(sender=self.__class__)
+                    with connections[alias].cursor() as cursor:
+                        cursor.execute(QUERY)
+                        cursor.fetchone()
+                    request_finished.send(sender=self.__class__)
+                    latencies.append(time.time() - start)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections[alias].close()
+
+        threads = [threading.Thread(target=work, args=(requests // workers,)) for _ in range(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        if errors:
+            raise CommandError('%s: %s' % (alias, errors[0]))
+
+        latencies.sort()
+        self.stdout.write('%-7s CONN_MAX_AGE=%-4d %8.0f req/s  p50 %6.2f ms  p99 %6.2f ms  %5d connects' % (
+            target, max_age, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[len(latencies) * 99 // 100] * 1000, stats[alias, 'connects']))
@@ -0,0 +1,126 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from ujscert.headquarter.ingest import index_websites, upsert_fingerprints
+from ujscert.headquarter.models import Website, App, Fingerprint
+
+APPS = ['nginx', 'Apache', 'PHP', 'jQuery', 'Bootstrap', 'WordPress', 'IIS', 'ASP.NET', 'Tomcat', 'Discuz!']
+
+
+def fake_page(n, html_size):
+    host = '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+    apps = random.sample(APPS, 8)
+    return {
+        'domain': 'host%d.example.edu.cn' % n,
+        'ip': host,
+        'port': 80,
+        'url': 'http://host%d.example.edu.cn/index.php?id=%d' % (n, n),
+        'title': 'page %d' % n,
+        'headers': {'Server': apps[0], 'Content-Type': 'text/html'},
+        'rawHeader': 'HTTP/1.1 200 OK\r\nServer: %s\r\nContent-Type: text/html\r\n' % apps[0],
+        'html': ('<p>%d lorem ipsum dolor sit amet</p>' % n) * (html_size // 32),
+        'apps': apps,
+        'detail': {app: {'version': '1.%d' % i, 'versions': ['1.%d' % i]} for i, app in enumerate(apps)},
+    }
+
+
+def fake_fingerprint(n, services, html_size):
+    """the n-th scan result, ip:ports repeat every `services` results like successive rescans do"""
+    n %= services
+    product = APPS[n % len(APPS)]
+    return {
+        'ip': '10.%d.%d.%d' % (n >> 14 & 255, n >> 6 & 255, n & 63),
+        'port': 20 + n % 4,
+        'service': 'http',
+        'product': product,
+        'version': '%d.%d' % (random.randint(1, 9), random.randint(0, 9)),
+        'cpes': ['a:%s:%s' % (product.lower(), product.lower())],
+        'banner': ('%d banner ' % n) * (html_size // 16),
+        'raw': '',
+    }
+
+
+def upsert_fingerprints_per_row(items):
+    """the previous host ingest path: one INSERT (plus tsvector UPDATE) per item, rescans add rows"""
+    for item in items:
+        Fingerprint(**item).save()
+
+
+def index_websites_per_row(items):
+    """the previous ingest path: one INSERT (plus tsvector UPDATE) per page and per app"""
+    for item in items:
+        website = Website(domain=item['domain'], ip=item['ip'], port=item['port'], url=item['url'],
+                          headers=item['headers'], html=item['html'], title=item['title'],
+                          raw_headers=item['rawHeader'], app_joint='/'.join(item['apps']))
+        website.save()
+        for name, app in item['detail'].items():
+            App(app=name, ver=app['version'], website=website, versions=app['versions']).save()
+
+
+class Command(BaseCommand):
+    help = '''Measure rows/sec and table growth of the web or host ingest path at several batch sizes.
+    All writes are rolled back, the host per-row path writes to a temporary copy of the table.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', default='web', help='web or host (default: web)')
+        parser.add_argument('--batch-sizes', default='10,100,1000',
+                            help='comma separated batch sizes (default: 10,100,1000)')
+        parser.add_argument('--pages', type=int, default=2000, help='pages (or fingerprints) to ingest per batch size')
+        parser.add_argument('--services', type=int, default=500,
+                            help='distinct ip:ports among host fingerprints, the rest are rescans (default: 500)')
+        parser.add_argument('--sweeps', type=int, default=1,
+                            help='times the web pages are submitted, later sweeps find them unchanged (default: 1)')
+        parser.add_argument('--html-size', type=int, default=8192, help='approximate html (or banner) bytes per row')
+        parser.add_argument('--per-row', action='store_true', help='also measure the per-row save() path')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['batch_sizes'].split(',')]
+
+        if options['topic'] == 'web':
+            model = Website
+            rows = [fake_page(n, options['html_size']) for n in range(options['pages'])] * options['sweeps']
+            paths = [('bulk', index_websites)]
+            if options['per_row']:
+                paths.append(('per-row', index_websites_per_row))
+        elif options['topic'] == 'host':
+            model = Fingerprint
+            rows = [fake_fingerprint(n, options['services'], options['html_size']) for n in range(options['pages'])]
+            paths = [('upsert', upsert_fingerprints)]
+            if options['per_row']:
+                paths.append(('per-row', upsert_fingerprints_per_row))
+        else:
+            raise CommandError('unknown topic %s' % options['topic'])
+
+        # growth counts dead tuples too, as nothing is vacuumed inside the transaction; rows kept is what stays
+        self.stdout.write('%-8s %10s %10s %12s %12s %10s' % (
+            'path', 'batch', 'rows', 'rows/sec', 'growth KiB', 'rows kept'))
+        for name, ingest in paths:
+            for size in sizes:
+                rate, growth, kept = self.measure(model, ingest, rows, size, unique=name != 'per-row')
+                self.stdout.write('%-8s %10d %10d %12.1f %12d %10d' % (
+                    name, size, len(rows), rate, growth // 1024, kept))
+
+    def measure(self, model, ingest, rows, size, unique=True):
+        table = model._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not unique and model is Fingerprint:
+                # the per-row path appends every rescan, so it writes to a temporary copy without the (ip, port)
+                # constraint; it shadows the table for this session only and the live one is never locked
+                cursor.execute('CREATE TEMP TABLE %s (LIKE public.%s INCLUDING DEFAULTS) ON COMMIT DROP' % (table, table))
+
+            cursor.execute('SELECT pg_total_relation_size(%s), count(*) FROM ' + table, [table])
+            before, count = cursor.fetchone()
+
+            start = time.time()
+            for offset in range(0, len(rows), size):
+                ingest(rows[offset:offset + size])
+            elapsed = time.time() - start
+
+            cursor.execute('SELECT pg_total_relation_size(%s), count(*) FROM ' + table, [table])
+            after, kept = cursor.fetchone()
+            transaction.set_rollback(True)
+
+        return len(rows) / elapsed, after - before, kept - count
@@ -0,0 +1,89 @@
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+import ujson
+from django.core.management.base import BaseCommand, CommandError
+
+from ujscert.headquarter.management.commands.bench_ingest import fake_page
+
+
+class Command(BaseCommand):
+    help = '''Load test against running servers: the latency of a UI page while idle, then while agents flood the
+    ingest API with large uploads. With the API on its own worker pool (see gunicorn_api.py) the UI latency
+    should stay where it was, and the flood should see 429s rather than timeouts once the ingest queue is full.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ui-url', default='http://localhost:8000/top10', help='page probed for latency')
+        parser.add_argument('--api-url', default='http://localhost:8001/hq/api/index/web', help='ingest endpoint')
+        parser.add_argument('--dn', default='', help='X-Cert-DN of an enrolled agent, when the API is not in DEBUG')
+        parser.add_argument('--agents', type=int, default=20, help='concurrent uploading agents (default: 20)')
+        parser.add_argument('--batch', type=int, default=50, help='pages per upload (default: 50)')
+        parser.add_argument('--html-size', type=int, default=64 * 1024, help='bytes of html per page')
+        parser.add_argument('--seconds', type=float, default=15, help='length of each phase (default: 15)')
+        parser.add_argument('--interval', type=float, default=0.1, help='seconds between UI probes')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stopped = threading.Event()
+
+        idle = self.probe(options['seconds'])
+        self.report('idle', idle)
+
+        bodies = [ujson.dumps([fake_page(n * options['batch'] + i, options['html_size'])
+                               for i in range(options['batch'])]).encode() for n in range(options['agents'])]
+        self.stdout.write('flooding with %d agents, %.2f MB per upload' % (options['agents'], len(bodies[0]) / 1e6))
+
+        statuses = Counter()
+        self.stopped.clear()
+        agents = [threading.Thread(target=self.upload, args=(body, statuses)) for body in bodies]
+        for agent in agents:
+            agent.start()
+        try:
+            flood = self.probe(options['seconds'])
+        finally:
+            self.stopped.set()
+            for agent in agents:
+                agent.join()
+
+        self.report('flood', flood)
+        self.stdout.write('uploads: %s' % ', '.join('%s %d' % item for item in sorted(statuses.items())))
+
+    def probe(self, seconds):
+        latencies = []
+        end = time.time() + seconds
+        while time.time() < end:
+            start = time.time()
+            try:
+                urllib.request.urlopen(self.options['ui_url'], timeout=60).read()
+            except (urllib.error.URLError, OSError) as e:
+                raise CommandError('%s: %s' % (self.options['ui_url'], e))
+            latencies.append(time.time() - start)
+            time.sleep(self.options['interval'])
+        return sorted(latencies)
+
+    def upload(self, body, statuses):
+        headers = {'Content-Type': 'application/json', 'X-Verified': 'SUCCESS', 'X-Cert-DN': self.options['dn']}
+        while not self.stopped.is_set():
+            request = urllib.request.Request(self.options['api_url'], body, headers)
+            retry_after = 0
+            try:
+                with urllib.request.urlopen(request, timeout=120) as response:
+                    response.read()
+                    statuses[str(response.status)] += 1
+            except urllib.error.HTTPError as e:
+                statuses[str(e.code)] += 1
+                retry_after = int(e.headers.get('Retry-After') or 0)
+            except (urllib.error.URLError, OSError) as e:
+                statuses[type(e).__name__] += 1
+                retry_after = 1
+            self.stopped.wait(retry_after)
+
+    def report(self, phase, latencies):
+        def percentile(p):
+            return latencies[min(len(latencies) * p // 100, len(latencies) - 1)] * 1000
+
+        self.stdout.write('%-6s UI %4d probes  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  max %7.1f ms' % (
+            phase, len(latencies), percentile(50), percentile(95), percentile(99), latencies[-1] * 1000))
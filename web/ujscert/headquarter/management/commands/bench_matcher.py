@@ -0,0 +1,62 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from ujscert.headquarter.matcher import Matcher
+
+WORDS = ['remote', 'code', 'execution', 'vulnerability', 'in', 'allows', 'attackers', 'to', 'via', 'crafted',
+         'request', 'server', 'before', 'version', 'buffer', 'overflow', 'cross-site', 'scripting', 'sql', 'injection',
+         '远程', '代码', '执行', '漏洞', '攻击者', '利用']
+
+
+def fake_term(n):
+    suffix = random.choice((' server', ' cms', 'd', ''))
+    return '%s%d%s' % (random.choice(('lib', 'open', 'web', 'net', 'py', 'x')), n, suffix)
+
+
+def fake_alert(terms, words):
+    text = [random.choice(WORDS) for _ in range(words)]
+    for _ in range(random.randint(0, 3)):
+        text.insert(random.randrange(len(text)), random.choice(terms))
+    return ' '.join(text)
+
+
+class Command(BaseCommand):
+    help = '''Time the alert keyword matcher against a synthetic dictionary: automaton build, incremental additions,
+    and alerts/sec compared with one regular expression search per term.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--terms', type=int, default=50000, help='dictionary size (default: 50000)')
+        parser.add_argument('--alerts', type=int, default=2000, help='alerts to scan (default: 2000)')
+        parser.add_argument('--words', type=int, default=200, help='words per alert (default: 200)')
+        parser.add_argument('--naive', type=int, default=20,
+                            help='alerts scanned term by term, 0 to skip (default: 20)')
+
+    def handle(self, *args, **options):
+        terms = [fake_term(n) for n in range(options['terms'])]
+        alerts = [fake_alert(terms, options['words']) for _ in range(options['alerts'])]
+
+        start = time.time()
+        matcher = Matcher(terms)
+        self.stdout.write('built %d terms in %.2fs' % (len(matcher), time.time() - start))
+
+        start = time.time()
+        found = sum(len(matcher.find(alert)) for alert in alerts)
+        elapsed = time.time() - start
+        self.stdout.write('automaton  %8.1f alerts/sec  %d matches' % (len(alerts) / elapsed, found))
+
+        start = time.time()
+        matcher.add(fake_term(options['terms'] + n) for n in range(100))
+        self.stdout.write('added 100 terms in %.4fs' % (time.time() - start))
+
+        if options['naive']:
+            patterns = [re.compile(r'(?<!\w)%s(?!\w)' % re.escape(term.lower()), re.ASCII) for term in terms]
+            sample = alerts[:options['naive']]
+            start = time.time()
+            for alert in sample:
+                text = alert.lower()
+                [pattern for pattern in patterns if pattern.search(text)]
+            elapsed = time.time() - start
+            self.stdout.write('per term   %8.1f alerts/sec' % (len(sample) / elapsed))
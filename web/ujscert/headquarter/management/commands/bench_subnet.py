@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+QUERIES = (
+    ('/8 count', "SELECT count(*) FROM bench_ip WHERE ip <<= '10.0.0.0/8'"),
+    ('/16 count', "SELECT count(*) FROM bench_ip WHERE ip <<= '10.20.0.0/16'"),
+    ('/24 rows', "SELECT id, ip FROM bench_ip WHERE ip <<= '10.20.30.0/24'"),
+    ('exact', "SELECT id FROM bench_ip WHERE ip = '10.20.30.40'"),
+    ('owner join', '''SELECT count(*) FROM bench_ip f JOIN bench_property p ON p.network >>= f.ip
+                      WHERE p.department = 'dept7' '''),
+)
+
+
+class Command(BaseCommand):
+    help = '''Time subnet containment queries over synthetic addresses, without an index, with a btree and with
+    GiST inet_ops. Everything lives in temporary tables.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10 * 1000 * 1000, help='addresses (default: 10M)')
+        parser.add_argument('--networks', type=int, default=1000, help='synthetic properties (default: 1000)')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per query, the best is reported')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            start = time.time()
+            # addresses spread over 10.0.0.0/8 and 172.16.0.0/12, like a campus scan
+            cursor.execute('''
+                CREATE TEMP TABLE bench_ip ON COMMIT DROP AS
+                SELECT n AS id, CASE WHEN n %% 4 = 0 THEN '172.16.0.0'::inet + (n * 7919 %% 1048576)
+                                     ELSE '10.0.0.0'::inet + (n * 104729 %% 16777216) END AS ip
+                FROM generate_series(1::bigint, %s) AS n''', [options['rows']])
+            cursor.execute('''
+                CREATE TEMP TABLE bench_property ON COMMIT DROP AS
+                SELECT n AS id, set_masklen(('10.0.0.0'::inet + n * 4096)::cidr, 20) AS network,
+                       'dept' || (n %% 20) AS department
+                FROM generate_series(0, %s - 1) AS n''', [options['networks']])
+            cursor.execute('ANALYZE bench_ip; ANALYZE bench_property')
+            self.stdout.write('generated %d rows in %.1fs' % (options['rows'], time.time() - start))
+
+            self.run(cursor, 'no index', options['repeat'])
+
+            start = time.time()
+            cursor.execute('CREATE INDEX bench_ip_btree ON bench_ip (ip); ANALYZE bench_ip')
+            self.stdout.write('btree built in %.1fs' % (time.time() - start))
+            self.run(cursor, 'btree', options['repeat'])
+
+            start = time.time()
+            cursor.execute('''DROP INDEX bench_ip_btree;
+                              CREATE INDEX bench_ip_gist ON bench_ip USING gist (ip inet_ops);
+                              CREATE INDEX bench_property_gist ON bench_property USING gist (network inet_ops);
+                              ANALYZE bench_ip; ANALYZE bench_property''')
+            self.stdout.write('gist built in %.1fs' % (time.time() - start))
+            self.run(cursor, 'gist', options['repeat'])
+
+    def run(self, cursor, index, repeat):
+        for name, sql in QUERIES:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                cursor.execute(sql)
+                cursor.fetchall()
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            cursor.execute('EXPLAIN ' + sql)
+            plan = ' '.join(line.strip() for line, in cursor.fetchall())
+            scan = next((node for node in ('Index Only Scan', 'Bitmap Index Scan', 'Index Scan', 'Seq Scan')
+                         if node in plan), '?')
+            self.stdout.write('%-8s %-12s %10.1f ms  %s' % (index, name, best * 1000, scan))
@@ -0,0 +1,46 @@
+import os
+import uuid
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ujscert.headquarter.models import Agent
+from ujscert.headquarter.utils import issue_cert, load_ca
+
+
+class Command(BaseCommand):
+    help = 'Create N agents, issuing their certificates in parallel across CPU cores.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='number of agents to create')
+        parser.add_argument('--prefix', default='agent', help='agents are named <prefix>-1 .. <prefix>-N')
+        parser.add_argument('--description', default='')
+        parser.add_argument('--processes', type=int, default=None, help='worker processes (default: CPU count)')
+        parser.add_argument('--out', help='also write <uid>.crt and <uid>.key for each agent into this directory')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if count <= 0:
+            raise CommandError('count must be positive')
+        if options['out'] and not os.path.isdir(options['out']):
+            raise CommandError('%s is not a directory' % options['out'])
+
+        load_ca()  # fail early on a bad CA, and let forked workers inherit the parsed material
+        uids = [uuid.uuid4() for _ in range(count)]
+        with Pool(options['processes']) as pool:
+            certs = pool.map(issue_cert, uids, chunksize=max(1, count // 64))
+
+        agents = [Agent(uid=uid, name='%s-%d' % (options['prefix'], n), description=options['description'],
+                        x509_cert=cert, x509_key=key)
+                  for n, (uid, (cert, key)) in enumerate(zip(uids, certs), 1)]
+        Agent.objects.bulk_create(agents, batch_size=500)
+
+        if options['out']:
+            for agent in agents:
+                base = os.path.join(options['out'], agent.uid.hex)
+                with open(base + '.crt', 'w') as f:
+                    f.write(agent.x509_cert)
+                with open(os.open(base + '.key', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                    f.write(agent.x509_key)
+
+        self.stdout.write('enrolled %d agents' % len(agents))
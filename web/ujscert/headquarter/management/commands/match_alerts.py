@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ujscert.headquarter.ingest import highlight
+from ujscert.headquarter.matcher import inventory
+from ujscert.headquarter.models import Alert
+
+
+class Command(BaseCommand):
+    help = '''Match recent alerts against the current asset inventory again, so products that appeared after an
+    advisory was received still highlight it.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='alerts received in the last DAYS days (default: 30)')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        inventory.reload()
+        since = timezone.now() - timezone.timedelta(days=options['days'])
+        alerts = Alert.objects.filter(timestamp__gte=since).only('title', 'content', 'keywords', 'highlighted')
+
+        changed = 0
+        for alert in alerts.iterator():
+            if highlight(alert):
+                alert.save(update_fields=['keywords', 'highlighted'])
+                changed += 1
+
+        self.stdout.write('%d of %d alerts changed, %d terms, %.1fs' % (
+            changed, alerts.count(), len(inventory.matcher), time.time() - start))
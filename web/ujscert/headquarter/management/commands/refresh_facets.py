@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ujscert.headquarter.models import refresh_facets
+
+
+class Command(BaseCommand):
+    help = 'Recount the facet values listed on the asset search page.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument('--interval', type=float, default=600, help='seconds between refreshes in --loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.time()
+            written = refresh_facets()
+            self.stdout.write('counted %d facet values in %.1fs' % (written, time.time() - start))
+            if not options['loop']:
+                break
+
+            time.sleep(options['interval'])
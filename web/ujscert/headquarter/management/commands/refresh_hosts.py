@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ujscert.headquarter.models import refresh_hosts
+
+
+class Command(BaseCommand):
+    help = '''Rebuild the Host summaries from fingerprints. Ingest keeps them current incrementally,
+    a full rebuild repairs hosts whose fingerprints were changed behind its back (e.g. by queryset updates).'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('ips', nargs='*', help='only these ips (default: all)')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        written = refresh_hosts(options['ips'] or None)
+        self.stdout.write('refreshed %d hosts in %.1fs' % (written, time.time() - start))
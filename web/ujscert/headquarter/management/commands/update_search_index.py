@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ujscert.headquarter.models import Website, Fingerprint
+
+MODELS = {
+    'website': Website,
+    'fingerprint': Fingerprint,
+}
+
+
+class Command(BaseCommand):
+    help = 'Rebuild full-text vectors of rows marked dirty by deferred indexing (SEARCH_INDEX_DEFERRED).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='%s (default: all)' % ', '.join(sorted(MODELS)))
+        parser.add_argument('--batch-size', type=int, default=5000, help='rows per UPDATE statement')
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument('--interval', type=float, default=10, help='seconds to sleep when idle in --loop mode')
+        parser.add_argument('--status', action='store_true', help='only report the backlog size')
+
+    def handle(self, *args, **options):
+        unknown = set(options['models']) - set(MODELS)
+        if unknown:
+            raise CommandError('unknown model: %s' % ', '.join(sorted(unknown)))
+
+        models = [MODELS[name] for name in options['models'] or sorted(MODELS)]
+
+        if options['status']:
+            for model in models:
+                self.stdout.write('%s: %d dirty rows' % (model.__name__, self.backlog(model)))
+            return
+
+        while True:
+            updated = sum(self.drain(model, options['batch_size']) for model in models)
+            if not options['loop']:
+                break
+
+            if not updated:
+                time.sleep(options['interval'])
+
+    @staticmethod
+    def backlog(model):
+        return model.objects.filter(search_dirty=True).count()
+
+    def drain(self, model, batch_size):
+        total, start = 0, time.time()
+
+        while True:
+            batch_start = time.time()
+            rows = model.objects.update_dirty_search_fields(batch_size)
+            if not rows:
+                break
+
+            total += rows
+            elapsed = time.time() - batch_start
+            self.stdout.write('%s: %d rows in %.2fs (%.1f rows/sec), backlog %d' % (
+                model.__name__, rows, elapsed, rows / elapsed, self.backlog(model)))
+
+        if total:
+            elapsed = time.time() - start
+            self.stdout.write('%s: %d rows indexed, %.1f rows/sec' % (model.__name__, total, total / elapsed))
+
+        return total
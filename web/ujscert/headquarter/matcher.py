@@ -0,0 +1,201 @@
+import string
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+
+WORD_CHARS = frozenset(string.ascii_lowercase + string.digits + '_')
+TERM_MIN_LENGTH = 3  # shorter product names ("go", "x") would match almost every advisory
+
+
+def cpe_product(cpe):
+    """'cpe:/a:nginx:nginx:1.4.6' -> 'nginx', 'a:igor_sysoev:nginx_plus' -> 'nginx plus'"""
+    parts = cpe.replace('cpe:2.3:', '').replace('cpe:/', '').split(':')
+    return parts[2].replace('_', ' ') if len(parts) > 2 else ''
+
+
+class Matcher(object):
+    """
+    Aho-Corasick automaton over lowercased terms, finds all of them in a text in one pass.
+    A match must sit on ASCII word boundaries: "php" is found in "PHP 5.6" and "php-fpm" but not in "phpMyAdmin",
+    Chinese text next to a term counts as a boundary.
+    Terms can be added at any time: a bulk load links the whole trie once, later additions link only their new
+    states and repoint the few existing states whose longest suffix they become, so find() never relinks.
+    """
+
+    def __init__(self, terms=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._parent = [(0, '')]  # the state and char leading to each state
+        self._children = [set()]  # the failure tree: states whose failure link points at each state
+        self._own = [()]  # the term ending at each state
+        self._out = [()]  # terms ending at each state or at its failure chain
+        self._terms = {}  # lowercased -> as first added
+        self._lock = threading.Lock()
+        self.add(terms)
+
+    def __len__(self):
+        return len(self._terms)
+
+    def add(self, terms):
+        """returns how many of `terms` were new"""
+        added = 0
+        with self._lock:
+            states = len(self._goto)
+            ended = []  # states that existed before and now end a term
+            for term in terms:
+                term = (term or '').strip()
+                key = term.lower()
+                if len(key) < TERM_MIN_LENGTH or key in self._terms:
+                    continue
+
+                state = 0
+                for char in key:
+                    child = self._goto[state].get(char)
+                    if child is None:
+                        child = self._goto[state][char] = len(self._goto)
+                        self._goto.append({})
+                        self._fail.append(0)
+                        self._depth.append(self._depth[state] + 1)
+                        self._parent.append((state, char))
+                        self._children.append(set())
+                        self._own.append(())
+                        self._out.append(())
+                    state = child
+
+                self._own[state] = (key,)
+                self._terms[key] = term
+                added += 1
+                if state < states:
+                    ended.append(state)
+
+            if len(self._goto) - states > states:  # mostly new states, e.g. the first load
+                self._link()
+            else:
+                # by depth, so the states a new one can fail to are linked before it
+                for state in sorted(range(states, len(self._goto)), key=self._depth.__getitem__):
+                    self._link_new(state)
+                for state in ended:
+                    self._relay(state)
+        return added
+
+    def _link(self):
+        goto, fail, own, out, children = self._goto, self._fail, self._own, self._out, self._children
+        for followers in children:
+            followers.clear()
+
+        queue = deque(goto[0].values())
+        for state in queue:
+            fail[state] = 0
+            out[state] = own[state]
+            children[0].add(state)
+
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].items():
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[child] = goto[link].get(char, 0)
+                children[fail[child]].add(child)
+                out[child] = own[child] + out[fail[child]]
+                queue.append(child)
+
+    def _link_new(self, state):
+        """
+        Link a state added since the last link. Existing states reached by the same char from a state whose suffix
+        is the new state's parent, found in the parent's failure subtree, now have it as a longer suffix.
+        """
+        goto, fail, depth, children = self._goto, self._fail, self._depth, self._children
+        parent, char = self._parent[state]
+
+        link = 0
+        if parent:
+            link = fail[parent]
+            while link and char not in goto[link]:
+                link = fail[link]
+            link = goto[link].get(char, 0)
+        self._set_fail(state, link)
+
+        queue = deque(children[parent])
+        while queue:
+            suffix = queue.popleft()
+            child = goto[suffix].get(char)
+            if child is None:
+                queue.extend(children[suffix])
+            elif child != state and depth[fail[child]] < depth[state]:
+                self._set_fail(child, state)
+            # else the subtree below `suffix` fails through `child`, which already has the longest suffix
+
+    def _set_fail(self, state, link):
+        self._children[self._fail[state]].discard(state)
+        self._fail[state] = link
+        self._children[link].add(state)
+        self._relay(state)
+
+    def _relay(self, state):
+        """recompute the terms found at `state` and at every state failing through it"""
+        own, out, fail, children = self._own, self._out, self._fail, self._children
+        queue = deque([state])
+        while queue:
+            current = queue.popleft()
+            out[current] = own[current] + out[fail[current]]
+            queue.extend(children[current])
+
+    def find(self, text):
+        """the distinct terms found in `text`, sorted, spelled as they were added"""
+        with self._lock:
+            goto, fail, out = self._goto, self._fail, self._out
+            text = text.lower()
+            last = len(text) - 1
+            found = set()
+            state = 0
+            for end, char in enumerate(text):
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+
+                for key in out[state]:
+                    start = end - len(key) + 1
+                    if (start == 0 or text[start - 1] not in WORD_CHARS) and \
+                            (end == last or text[end + 1] not in WORD_CHARS):
+                        found.add(key)
+
+            return sorted(self._terms[key] for key in found)
+
+
+def inventory_terms():
+    """every product name we run: fingerprint products and web apps from the catalog, and the products of cpes"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT name FROM headquarter_product UNION SELECT name FROM headquarter_cpeproduct')
+        return [term for term, in cursor.fetchall()]
+
+
+class Inventory(object):
+    """
+    A Matcher of the asset inventory, loaded on first use. Ingest adds the products it writes in this process,
+    products written by other processes are picked up by a reload at most every MATCHER_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.matcher = Matcher()
+        self.loaded = None
+
+    def add(self, terms):
+        return self.matcher.add(terms)
+
+    def reload(self):
+        added = self.matcher.add(inventory_terms())
+        self.loaded = time.monotonic()
+        return added
+
+    def find(self, text):
+        if self.loaded is None or time.monotonic() - self.loaded > getattr(settings, 'MATCHER_REFRESH_INTERVAL', 300):
+            self.reload()
+        return self.matcher.find(text)
+
+
+inventory = Inventory()
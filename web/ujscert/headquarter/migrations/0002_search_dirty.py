@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0001_initial'),
+    ]
+
+    operations = [
+        # existing rows already have fresh vectors, only rows written from now on start dirty
+        migrations.AddField(
+            model_name='fingerprint',
+            name='search_dirty',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='fingerprint',
+            name='search_dirty',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='website',
+            name='search_dirty',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='website',
+            name='search_dirty',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_fingerprint_search_dirty ON headquarter_fingerprint (id) WHERE search_dirty',
+            'DROP INDEX headquarter_fingerprint_search_dirty',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_website_search_dirty ON headquarter_website (id) WHERE search_dirty',
+            'DROP INDEX headquarter_website_search_dirty',
+        ),
+    ]
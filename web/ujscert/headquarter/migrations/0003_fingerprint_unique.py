@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0002_search_dirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FingerprintHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip', models.GenericIPAddressField()),
+                ('port', models.PositiveIntegerField()),
+                ('service', models.CharField(blank=True, max_length=64)),
+                ('product', models.CharField(blank=True, max_length=256)),
+                ('version', models.CharField(blank=True, max_length=128)),
+                ('seen', models.DateTimeField()),
+            ],
+        ),
+        # keep the latest fingerprint of every ip:port, older rescans move to the history table
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_fingerprinthistory (ip, port, service, product, version, seen)
+               SELECT f.ip, f.port, f.service, f.product, f.version, f.timestamp
+               FROM headquarter_fingerprint f
+               WHERE EXISTS (SELECT 1 FROM headquarter_fingerprint n WHERE n.ip = f.ip AND n.port = f.port
+                             AND (n.timestamp, n.id) > (f.timestamp, f.id));
+               DELETE FROM headquarter_fingerprint f USING headquarter_fingerprint n
+               WHERE n.ip = f.ip AND n.port = f.port AND (n.timestamp, n.id) > (f.timestamp, f.id)''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='fingerprint',
+            unique_together=set([('ip', 'port')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='fingerprinthistory',
+            index_together=set([('ip', 'port', 'seen')]),
+        ),
+    ]
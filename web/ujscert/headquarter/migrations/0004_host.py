@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:39
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0003_fingerprint_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Host',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip', models.GenericIPAddressField(unique=True)),
+                ('ports', django.contrib.postgres.fields.ArrayField(base_field=models.PositiveIntegerField(), default=[], size=None)),
+                ('services', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(blank=True, max_length=64), default=[], size=None)),
+                ('timestamp', models.DateTimeField()),
+                ('refreshed', models.DateTimeField()),
+            ],
+        ),
+        # serves the DISTINCT ON (ip) ... ORDER BY ip, timestamp DESC of host search without a sort
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_fingerprint_ip_timestamp ON headquarter_fingerprint (ip, timestamp DESC)',
+            'DROP INDEX headquarter_fingerprint_ip_timestamp',
+        ),
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_host (ip, ports, services, timestamp, refreshed)
+               SELECT ip, array_agg(port ORDER BY port), array_agg(service ORDER BY port), max(timestamp), now()
+               FROM headquarter_fingerprint GROUP BY ip''',
+            migrations.RunSQL.noop,
+        ),
+    ]
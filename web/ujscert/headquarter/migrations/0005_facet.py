@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0004_host'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Facet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=16)),
+                ('value', models.CharField(blank=True, max_length=256)),
+                ('count', models.IntegerField()),
+                ('refreshed', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='facet',
+            unique_together=set([('field', 'value')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='facet',
+            index_together=set([('field', 'count')]),
+        ),
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_facet (field, value, count, refreshed)
+               SELECT 'port', port::text, count(*), now() FROM headquarter_fingerprint GROUP BY port
+               UNION ALL SELECT 'device', device, count(*), now() FROM headquarter_fingerprint GROUP BY device
+               UNION ALL SELECT 'service', service, count(*), now() FROM headquarter_fingerprint GROUP BY service
+               UNION ALL SELECT 'os', os, count(*), now() FROM headquarter_fingerprint GROUP BY os
+               UNION ALL SELECT 'product', product, count(*), now() FROM headquarter_fingerprint GROUP BY product
+               UNION ALL SELECT 'app', app, count(*), now() FROM headquarter_app GROUP BY app''',
+            migrations.RunSQL.noop,
+        ),
+    ]
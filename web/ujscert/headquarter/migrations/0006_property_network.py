@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:43
+from __future__ import unicode_literals
+
+from django.db import migrations
+import ujscert.headquarter.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0005_facet'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='property',
+            options={'verbose_name_plural': 'properties'},
+        ),
+        migrations.AddField(
+            model_name='property',
+            name='network',
+            field=ujscert.headquarter.models.CidrField(blank=True, null=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE headquarter_property SET network = set_masklen(ip::cidr, CASE family(ip) WHEN 4 THEN 32 ELSE 128 END)',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='property',
+            name='network',
+            field=ujscert.headquarter.models.CidrField(blank=True),
+        ),
+        # GiST inet_ops serves containment (<<=, >>=) and equality on inet/cidr, unlike the default btree
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_property_network_gist ON headquarter_property USING gist (network inet_ops)',
+            'DROP INDEX headquarter_property_network_gist',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_fingerprint_ip_gist ON headquarter_fingerprint USING gist (ip inet_ops)',
+            'DROP INDEX headquarter_fingerprint_ip_gist',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX headquarter_website_ip_gist ON headquarter_website USING gist (ip inet_ops)',
+            'DROP INDEX headquarter_website_ip_gist',
+        ),
+    ]
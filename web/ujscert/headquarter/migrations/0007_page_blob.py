@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0006_property_network'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageBlob',
+            fields=[
+                ('digest', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('html', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='website',
+            name='page',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='headquarter.PageBlob'),
+        ),
+        # md5(text) hashes the same UTF-8 bytes as PageBlob.of()
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_pageblob (digest, html)
+               SELECT DISTINCT ON (md5(html)) md5(html), html FROM headquarter_website WHERE length(html) > 0;
+               UPDATE headquarter_website SET page_id = md5(html) WHERE length(html) > 0''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RemoveField(
+            model_name='website',
+            name='html',
+        ),
+    ]
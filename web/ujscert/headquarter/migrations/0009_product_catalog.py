@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 07:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0008_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('first_seen', models.DateTimeField(db_index=True)),
+                ('last_seen', models.DateTimeField()),
+                ('occurrences', models.BigIntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_product (name, first_seen, last_seen, occurrences)
+               SELECT name, min(first_seen), max(last_seen), sum(n) FROM (
+                   SELECT product, min(timestamp), max(timestamp), count(*) FROM headquarter_fingerprint
+                   WHERE product <> '' GROUP BY product
+                   UNION ALL SELECT a.app, min(w.timestamp), max(w.last_seen), count(*) FROM headquarter_app a
+                   JOIN headquarter_website w ON w.id = a.website_id WHERE a.app <> '' GROUP BY a.app
+               ) AS seen (name, first_seen, last_seen, n) GROUP BY name''',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 08:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('headquarter', '0009_product_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CpeProduct',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('first_seen', models.DateTimeField()),
+            ],
+        ),
+        # the product part of fingerprint cpes, as matcher.cpe_product() takes it
+        migrations.RunSQL(
+            '''INSERT INTO headquarter_cpeproduct (name, first_seen)
+               SELECT name, min(timestamp) FROM (
+                   SELECT replace(split_part(replace(replace(cpe, 'cpe:2.3:', ''), 'cpe:/', ''), ':', 3), '_', ' '),
+                       f.timestamp
+                   FROM headquarter_fingerprint f, unnest(f.cpes) AS cpe
+               ) AS seen (name, timestamp) WHERE name <> '' GROUP BY name''',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,13 +1,160 @@
+import hashlib
 import uuid
+from ipaddress import ip_network
+from collections import Counter
+from itertools import repeat
 
+from django import forms
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.db import models
-from django.db.models.signals import pre_save
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import models, connections, transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from djorm_pgfulltext.fields import VectorField
 from djorm_pgfulltext.models import SearchManager
 
-from ujscert.headquarter.utils import gen_cert
+from ujscert.cache import LRUCache, invalidate_models, model_versions
+from ujscert.headquarter.utils import gen_cert, parse_dn
+
+
+class InNetwork(models.Lookup):
+    """ip__in_network='10.0.0.0/8': the address lies in the network, PostgreSQL's inet <<= operator"""
+    lookup_name = 'in_network'
+
+    def get_prep_lookup(self):
+        return self.rhs
+
+    def as_sql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        return '%s <<= %%s::inet' % lhs, params + [self.rhs]
+
+
+class InDepartment(models.Lookup):
+    """ip__department='cs': the address lies in the network of a Property owned by that department"""
+    lookup_name = 'department'
+
+    def get_prep_lookup(self):
+        return self.rhs
+
+    def as_sql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        return 'EXISTS (SELECT 1 FROM headquarter_property p WHERE lower(p.department) = lower(%%s) ' \
+               'AND p.network >>= %s)' % lhs, [self.rhs] + params
+
+
+models.GenericIPAddressField.register_lookup(InNetwork)
+models.GenericIPAddressField.register_lookup(InDepartment)
+
+
+class CidrField(models.Field):
+    """an IPv4 or IPv6 network such as 202.195.0.0/16, stored as PostgreSQL cidr"""
+    description = 'IP network'
+
+    def db_type(self, connection):
+        return 'cidr'
+
+    def to_python(self, value):
+        if not value:
+            return None
+        try:
+            return str(ip_network(str(value).strip()))
+        except ValueError:
+            raise ValidationError('%s is not a valid network, e.g. 202.195.0.0/16' % value, code='invalid')
+
+    def get_prep_value(self, value):
+        return self.to_python(super(CidrField, self).get_prep_value(value))
+
+    def formfield(self, **kwargs):
+        defaults = {'form_class': forms.CharField}
+        defaults.update(kwargs)
+        return super(CidrField, self).formfield(**defaults)
+
+
+def sync_search_field_handler(sender, instance, **kwargs):
+    sender._fts_manager.sync_search_field(instance.pk)
+
+
+class IndexedSearchManager(SearchManager):
+    """
+    SearchManager that keeps a `search_dirty` flag next to the vector.
+
+    With settings.SEARCH_INDEX_DEFERRED, saves skip the per-row vector UPDATE and leave the row dirty,
+    `manage.py update_search_index` then rebuilds the vectors of dirty rows in large batches.
+
+    Fields may follow a foreign key, e.g. 'page__html', to index text kept in another table.
+    """
+
+    def _get_search_vector(self, config, using, fields=None):
+        fields = fields or self._fields
+        local = [field for field in fields if '__' not in field]
+        vectors = [super(IndexedSearchManager, self)._get_search_vector(config, using, fields=local)]
+        vectors += [self._get_vector_for_related(field, config, using) for field in fields if '__' in field]
+        return ' || '.join(vectors)
+
+    def _get_vector_for_related(self, path, config, using):
+        qn = connections[using or self.db].ops.quote_name
+        name, column = path.split('__', 1)
+        fk = self.model._meta.get_field(name)
+        related = fk.related_model._meta
+        subquery = '(SELECT %s FROM %s WHERE %s = %s.%s)' % (
+            qn(related.get_field(column).column), qn(related.db_table),
+            qn(related.pk.column), qn(self.model._meta.db_table), qn(fk.column))
+        return "setweight(to_tsvector('%s', coalesce(%s, '')), '%s')" % (config, subquery, self.default_weight)
+
+    def contribute_to_class(self, cls, name):
+        super(IndexedSearchManager, self).contribute_to_class(cls, name)
+        if not cls._meta.abstract:
+            models.signals.post_save.connect(sync_search_field_handler, sender=cls)
+
+    @property
+    def deferred(self):
+        return getattr(settings, 'SEARCH_INDEX_DEFERRED', False)
+
+    def sync_search_field(self, pk):
+        """refresh vectors of freshly written rows, or mark them dirty when indexing is deferred"""
+        if not self.deferred:
+            self.update_search_field(pk=pk)
+            return
+
+        # e.g. an admin edit saves the search_dirty=False it loaded
+        pks = list(pk) if isinstance(pk, (list, tuple)) else [pk]
+        self.get_queryset().filter(pk__in=pks, search_dirty=False).update(search_dirty=True)
+
+    def update_search_field(self, pk=None, config=None, using=None):
+        qn = connections[using or self.db].ops.quote_name
+        where_sql, params = '', []
+        if pk is not None:
+            params = list(pk) if isinstance(pk, (list, tuple)) else [pk]
+            where_sql = 'WHERE %s IN (%s)' % (qn(self.model._meta.pk.column), ','.join(repeat('%s', len(params))))
+
+        return self._update_vectors(where_sql, params, config, using)
+
+    def update_dirty_search_fields(self, limit, config=None, using=None):
+        """rebuild vectors of at most `limit` dirty rows with one set-based UPDATE, returns the row count"""
+        qn = connections[using or self.db].ops.quote_name
+        pk = qn(self.model._meta.pk.column)
+        # ARRAY() runs the subquery once, an IN (...) subplan may be rescanned and lock more than `limit` rows
+        where_sql = 'WHERE %s = ANY(ARRAY(SELECT %s FROM %s WHERE search_dirty ORDER BY %s LIMIT %%s FOR UPDATE))' % (
+            pk, pk, qn(self.model._meta.db_table), pk)
+        return self._update_vectors(where_sql, [limit], config, using)
+
+    def _update_vectors(self, where_sql, params, config, using):
+        using = using or self.db
+        qn = connections[using].ops.quote_name
+        sql = 'UPDATE %s SET %s = %s, search_dirty = false %s' % (
+            qn(self.model._meta.db_table),
+            qn(self.search_field),
+            self._get_search_vector(config or self.config, using),
+            where_sql,
+        )
+
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.rowcount
 
 
 class Agent(models.Model):
@@ -27,12 +174,103 @@ def pre_save_hook(sender, instance, **kwargs):
         instance.x509_cert, instance.x509_key = gen_cert(instance.uid)
 
 
+# certificate DN -> (Agent version, agent uid or None for a DN that names no agent)
+agent_identities = LRUCache(getattr(settings, 'AGENT_CACHE_SIZE', 1024), getattr(settings, 'AGENT_CACHE_TTL', 300))
+
+
+def identify_agent(cert_dn):
+    """
+    uid of the agent a verified certificate DN belongs to, or None.
+    Cached in the process under the version of the Agent model, which any change of an agent moves: other
+    processes stop accepting a revoked agent as soon as they see the new version, within LOCAL_TIMEOUT.
+    """
+    version = model_versions(Agent)[0]
+    entry = agent_identities.get(cert_dn)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    try:
+        uid = Agent.objects.values_list('uid', flat=True).get(uid=parse_dn(cert_dn).get('CN', ''))
+    except (ValueError, Agent.DoesNotExist):
+        uid = None
+    agent_identities.set(cert_dn, (version, uid))
+    return uid
+
+
+@receiver(post_delete, sender=Agent)
+@receiver(post_save, sender=Agent)
+def agent_changed(sender, instance, **kwargs):
+    agent_identities.clear()
+    invalidate_models(Agent)
+
+
 class Property(models.Model):
     ip = models.GenericIPAddressField()
+    network = CidrField(blank=True)  # the addresses this property covers, just ip when left blank
     name = models.CharField(max_length=20, blank=True)
     department = models.CharField(max_length=40, blank=True)
     description = models.TextField(blank=True)
 
+    class Meta:
+        verbose_name_plural = 'properties'
+
+    def __str__(self):
+        return self.name or self.network or self.ip
+
+    def save(self, *args, **kwargs):
+        if not self.network:
+            self.network = str(ip_network(self.ip))
+        super(Property, self).save(*args, **kwargs)
+
+
+def owning_properties(ips):
+    """{ip: Property} for the ips inside some Property network, the most specific network wins"""
+    ips = list(ips)
+    if not ips:
+        return {}
+
+    with connections['default'].cursor() as cursor:
+        cursor.execute('''
+            SELECT DISTINCT ON (a.ip) host(a.ip), p.id
+            FROM unnest(%s::inet[]) AS a(ip) JOIN headquarter_property p ON p.network >>= a.ip
+            ORDER BY a.ip, masklen(p.network) DESC''', [ips])
+        owners = dict(cursor.fetchall())
+
+    properties = Property.objects.in_bulk(set(owners.values()))
+    return {ip: properties[pk] for ip, pk in owners.items()}
+
+
+class PageBlobManager(models.Manager):
+    def store(self, blobs):
+        """insert blobs not stored yet, a page already seen (same digest) is written once"""
+        blobs = list({blob.digest: blob for blob in blobs}.values())
+        with connections[self.db].cursor() as cursor:
+            for offset in range(0, len(blobs), 100):
+                chunk = blobs[offset:offset + 100]
+                cursor.execute(
+                    'INSERT INTO headquarter_pageblob (digest, html) VALUES %s ON CONFLICT (digest) DO NOTHING' %
+                    ', '.join(['(%s, %s)'] * len(chunk)), [value for blob in chunk for value in (blob.digest, blob.html)])
+        for blob in blobs:
+            blob._state.adding = False
+
+
+class PageBlob(models.Model):
+    """
+    Page source, addressed by the md5 of its text so rescans of an unchanged page share one row.
+    Kept out of Website so that listing pages never reads it, PostgreSQL compresses it out of line (TOAST).
+    """
+    digest = models.CharField(max_length=32, primary_key=True)
+    html = models.TextField()
+
+    objects = PageBlobManager()
+
+    @classmethod
+    def of(cls, html):
+        return cls(digest=hashlib.md5(html.encode('utf8')).hexdigest(), html=html)
+
+    def __str__(self):
+        return self.digest
+
 
 class Website(models.Model):
     domain = models.CharField(max_length=64)
@@ -43,22 +281,50 @@ class Website(models.Model):
     url = models.CharField(max_length=512)
     headers = JSONField(default={})
     raw_headers = models.TextField(blank=True)
-    html = models.TextField()  # full html source
+    page = models.ForeignKey(PageBlob, null=True, blank=True, on_delete=models.SET_NULL)  # full html source
     app_joint = models.CharField(max_length=256, default='')  # ' '.join(apps), for full search
 
     timestamp = models.DateTimeField(auto_now=True)
+    last_seen = models.DateTimeField(default=timezone.now)  # latest scan that found this exact content
+    content_hash = models.CharField(max_length=32, blank=True)  # see ingest.content_hash
 
     search_index = VectorField(db_index=False)
-    objects = SearchManager(
-        fields=('domain', 'url', 'raw_headers', 'app_joint', 'html', 'title'),
+    search_dirty = models.BooleanField(default=True)  # search_index is stale, see IndexedSearchManager
+    objects = IndexedSearchManager(
+        fields=('domain', 'url', 'raw_headers', 'app_joint', 'page__html', 'title'),
         config='chinese',
         search_field='search_index',
-        auto_update_search_field=True
     )
 
     def __str__(self):
         return self.title
 
+    @property
+    def html(self):
+        """loaded on first access, use select_related('page') where pages are shown with their source"""
+        return self.page.html if self.page_id else ''
+
+    @html.setter
+    def html(self, value):
+        self.page = PageBlob.of(value) if value else None
+
+    def save(self, *args, **kwargs):
+        page = getattr(self, self._meta.get_field('page').get_cache_name(), None)  # without loading it
+        if page is not None and page._state.adding:
+            PageBlob.objects.store([page])
+        super(Website, self).save(*args, **kwargs)
+
+
+class WebsiteChange(models.Model):
+    """a rescan of `url` found different content, `website` is the new version, `previous` the one it replaces"""
+    url = models.CharField(max_length=512)
+    website = models.ForeignKey(Website, related_name='changes')
+    previous = models.ForeignKey(Website, null=True, on_delete=models.SET_NULL, related_name='+')
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.url
+
 
 class App(models.Model):
     website = models.ForeignKey(Website)
@@ -90,17 +356,231 @@ class Fingerprint(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
 
     search_index = VectorField(db_index=False)
-    objects = SearchManager(
+    search_dirty = models.BooleanField(default=True)  # search_index is stale, see IndexedSearchManager
+    objects = IndexedSearchManager(
         fields=('os', 'info', 'service', 'product', 'hostname', 'device', 'version', 'banner'),
         config='chinese',
         search_field='search_index',
-        auto_update_search_field=True
     )
 
+    class Meta:
+        unique_together = (('ip', 'port'),)  # one row per service, rescans update it in place
+
     def __str__(self):
         return '%s:%d' % (self.ip, self.port)
 
 
+class Host(models.Model):
+    """current state of one ip, summarized from its fingerprints by refresh_hosts()"""
+    ip = models.GenericIPAddressField(unique=True)
+    ports = ArrayField(models.PositiveIntegerField(), default=[])
+    services = ArrayField(models.CharField(max_length=64, blank=True), default=[])  # in the order of ports
+    timestamp = models.DateTimeField()  # latest scan of any port
+    refreshed = models.DateTimeField()  # when this summary was last rebuilt
+
+    def __str__(self):
+        return self.ip
+
+
+# advisory locks of refresh_hosts(), held until commit: (HOST_LOCK, 0) is taken shared to rebuild some hosts and
+# exclusively to rebuild them all, (HOST_LOCK + 1, hash of the ip) per host rebuilt
+HOST_LOCK = 0x6871
+
+
+def refresh_hosts(ips=None):
+    """
+    Rebuild the Host rows of `ips` (all hosts when None) from their fingerprints in two statements,
+    hosts without fingerprints left are removed. Returns the number of hosts written.
+    Concurrent ingests of the same ip take turns: each aggregates once the other committed, a summary from a
+    snapshot without the other's ports would overwrite it.
+    """
+    where, params = '', []
+    if ips is not None:
+        where, params = 'WHERE ip = ANY(%s::inet[])', [list(ips)]
+
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        if ips is None:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', [HOST_LOCK])
+        else:
+            cursor.execute('SELECT pg_advisory_xact_lock_shared(%s, 0)', [HOST_LOCK])
+            # in one order, so that two batches with several ips in common do not deadlock
+            cursor.execute('''
+                SELECT pg_advisory_xact_lock(%s, key) FROM (
+                    SELECT DISTINCT hashtext(host(ip)) AS key FROM unnest(%s::inet[]) AS ip ORDER BY key
+                ) AS locks''', [HOST_LOCK + 1, list(ips)])
+
+        cursor.execute('''
+            INSERT INTO headquarter_host (ip, ports, services, timestamp, refreshed)
+            SELECT ip, array_agg(port ORDER BY port), array_agg(service ORDER BY port), max(timestamp), now()
+            FROM headquarter_fingerprint %s GROUP BY ip
+            ON CONFLICT (ip) DO UPDATE SET ports = EXCLUDED.ports, services = EXCLUDED.services,
+                timestamp = EXCLUDED.timestamp, refreshed = EXCLUDED.refreshed''' % where, params)
+        written = cursor.rowcount
+
+        cursor.execute('''
+            DELETE FROM headquarter_host h WHERE %s
+            NOT EXISTS (SELECT 1 FROM headquarter_fingerprint f WHERE f.ip = h.ip)''' % (
+            'h.ip = ANY(%s::inet[]) AND' if ips is not None else ''), params)
+
+    return written
+
+
+SEARCH_VERSION_KEY = 'search:version:%s'  # per topic, cached search results carry it in their key
+
+
+def invalidate_search(topic):
+    """drop every cached search result of a topic ('host' or 'web') by moving it to a new version"""
+    def bump():
+        cache.set(SEARCH_VERSION_KEY % topic, uuid.uuid4().hex, None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+@receiver(post_delete, sender=Fingerprint)
+@receiver(post_save, sender=Fingerprint)
+def fingerprint_changed(sender, instance, **kwargs):
+    refresh_hosts([instance.ip])
+    invalidate_search('host')
+
+
+@receiver(post_delete, sender=App)
+@receiver(post_delete, sender=Website)
+@receiver(post_save, sender=App)
+@receiver(post_save, sender=Website)
+def website_changed(sender, instance, **kwargs):
+    invalidate_search('web')
+
+
+class FingerprintHistory(models.Model):
+    """compact record of fingerprints replaced by a rescan, kept when settings.FINGERPRINT_HISTORY is on"""
+    ip = models.GenericIPAddressField()
+    port = models.PositiveIntegerField()
+    service = models.CharField(max_length=64, blank=True)
+    product = models.CharField(max_length=256, blank=True)
+    version = models.CharField(max_length=128, blank=True)
+    seen = models.DateTimeField()
+
+    class Meta:
+        index_together = (('ip', 'port', 'seen'),)
+
+    def __str__(self):
+        return '%s:%d' % (self.ip, self.port)
+
+
+class Facet(models.Model):
+    """number of fingerprints (or web pages, for app) per distinct value of a searchable field"""
+    field = models.CharField(max_length=16)
+    value = models.CharField(max_length=256, blank=True)
+    count = models.IntegerField()
+    refreshed = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('field', 'value'),)
+        index_together = (('field', 'count'),)
+
+    def __str__(self):
+        return '%s:%s' % (self.field, self.value)
+
+
+# facet -> (table, column), in the order search_home shows them
+FACET_SOURCES = (
+    ('port', 'headquarter_fingerprint', 'port'),
+    ('device', 'headquarter_fingerprint', 'device'),
+    ('service', 'headquarter_fingerprint', 'service'),
+    ('os', 'headquarter_fingerprint', 'os'),
+    ('product', 'headquarter_fingerprint', 'product'),
+    ('app', 'headquarter_app', 'app'),
+)
+FACETS_CACHE_KEY = 'facets'
+FACETS_CACHE_SIZE = 100  # values cached per facet, the largest top-K served
+
+
+def refresh_facets():
+    """recount every facet in one transaction, one grouped scan per facet, returns the number of values"""
+    select = ' UNION ALL '.join(
+        "SELECT '%s', %s::text, count(*), now() FROM %s GROUP BY %s" % (facet, column, table, column)
+        for facet, table, column in FACET_SOURCES)
+
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        cursor.execute('DELETE FROM headquarter_facet')
+        cursor.execute('INSERT INTO headquarter_facet (field, value, count, refreshed) ' + select)
+        written = cursor.rowcount
+
+    cache.delete(FACETS_CACHE_KEY)
+    transaction.on_commit(lambda: cache.delete(FACETS_CACHE_KEY))
+    return written
+
+
+def top_facets(limit):
+    """
+    {facet: [(value, count), ...]} with the `limit` most frequent values of each facet.
+    Served from the cache, which other processes see refreshed within FACETS_CACHE_TIMEOUT.
+    """
+    facets = cache.get(FACETS_CACHE_KEY)
+    if facets is None:
+        facets = {facet: list(Facet.objects.filter(field=facet).order_by('-count', 'value')
+                              .values_list('value', 'count')[:FACETS_CACHE_SIZE])
+                  for facet, _, _ in FACET_SOURCES}
+        cache.set(FACETS_CACHE_KEY, facets, getattr(settings, 'FACETS_CACHE_TIMEOUT', 300))
+
+    return {facet: values[:limit] for facet, values in facets.items()}
+
+
+class Product(models.Model):
+    """a fingerprint product or web app name seen at ingest, the catalog agents poll through api/apps"""
+    name = models.CharField(max_length=256, unique=True)
+    first_seen = models.DateTimeField(db_index=True)
+    last_seen = models.DateTimeField()
+    occurrences = models.BigIntegerField()  # items ingested with this name, rescans included
+
+    def __str__(self):
+        return self.name
+
+
+def record_products(names):
+    """count `names` (repeats count) into the catalog with one upsert, returns how many names were new"""
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return 0
+
+    names = sorted(counts)  # a fixed lock order, concurrent ingests do not deadlock on the catalog
+    with connections['default'].cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO headquarter_product AS p (name, first_seen, last_seen, occurrences)
+            SELECT name, now(), now(), n FROM unnest(%s::varchar[], %s::bigint[]) AS data (name, n)
+            ON CONFLICT (name) DO UPDATE
+            SET last_seen = EXCLUDED.last_seen, occurrences = p.occurrences + EXCLUDED.occurrences
+            RETURNING xmax = 0''', [names, [counts[name] for name in names]])
+        return sum(new for new, in cursor.fetchall())
+
+
+class CpeProduct(models.Model):
+    """
+    The product part of a fingerprint cpe seen at ingest ('nginx plus'). Alerts mentioning it are highlighted,
+    but it is not in the catalog agents poll, where it would repeat product and app names in another spelling.
+    """
+    name = models.CharField(max_length=256, unique=True)
+    first_seen = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+def record_cpe_products(names):
+    """add the new `names` with one INSERT, returns how many were new"""
+    names = sorted({name for name in names if name})
+    if not names:
+        return 0
+
+    with connections['default'].cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO headquarter_cpeproduct (name, first_seen)
+            SELECT name, now() FROM unnest(%s::varchar[]) AS data (name)
+            ON CONFLICT (name) DO NOTHING''', [names])
+        return cursor.rowcount
+
+
 class Alert(models.Model):
     title = models.CharField(max_length=256)
     content = models.TextField(blank=True)
@@ -0,0 +1,213 @@
+import hashlib
+import shlex
+from ipaddress import ip_address, ip_network
+
+import ujson
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from ujscert.cache import stored_version
+from ujscert.headquarter.models import Fingerprint, Website, SEARCH_VERSION_KEY
+
+# key -> lookup, per topic. port and ip are handled by their own compilers, other keys are ignored
+TOPIC_FIELDS = {
+    'host': {
+        'os': 'os__iexact',
+        'product': 'product__iexact',
+        'service': 'service__iexact',
+        'hostname': 'hostname__iexact',
+        'device': 'device__iexact',
+        'version': 'version__iexact',
+        'ver': 'version__iexact',
+        'dept': 'ip__department',
+        'port': 'port',
+        'ip': 'ip',
+    },
+    'web': {
+        'app': 'app__app__iexact',
+        'ver': 'app__ver__iexact',
+        'domain': 'domain__iexact',
+        'dept': 'ip__department',
+        'port': 'port',
+        'ip': 'ip',
+    },
+}
+
+TEXT = ''  # key of bare words, matched against the full-text index
+
+# ids cached per query, a result with more rows is shown as "SEARCH_RESULT_LIMIT+"
+SEARCH_RESULT_LIMIT = 5000
+
+
+class QueryError(ValueError):
+    pass
+
+
+def normalize_port(value):
+    try:
+        ports = [int(port) for port in value.split('-', 1)]
+    except ValueError:
+        raise QueryError('invalid port: %s' % value)
+
+    if len(ports) == 2 and ports[0] > ports[1]:
+        ports.reverse()
+    return '-'.join(str(port) for port in ports)
+
+
+def normalize_ip(value):
+    try:
+        if '-' in value:
+            start, end = sorted((ip_address(ip.strip()) for ip in value.split('-', 1)))
+            return '%s-%s' % (start, end)
+
+        network = ip_network(value, strict=False)
+    except (ValueError, TypeError):  # TypeError: a range across IPv4 and IPv6
+        raise QueryError('invalid ip: %s' % value)
+
+    if network.num_addresses == 1 and '/' not in value:
+        return str(network.network_address)
+    return str(network)
+
+
+def normalize(topic, key, value):
+    if key == TEXT:
+        return value
+    if key == 'port':
+        return normalize_port(value)
+    if key == 'ip':
+        return normalize_ip(value)
+    return value.lower()  # matched case-insensitively
+
+
+class Query(object):
+    """
+    A parsed search, in a canonical form: a conjunction of groups, each group a disjunction of
+    (negated, key, value) terms. Terms are implicitly ANDed, `OR` joins neighbouring terms into one group
+    and `NOT` (or a leading `-`) negates the next term:
+
+        product:nginx ver:1.4
+        port:80 OR port:8000-9000 NOT ip:10.0.0.0/8
+        dept:cs ip:202.195.0.0/16
+        service:ssh -os:linux openssh
+
+    Terms on a field the topic does not have (product: of a web search) are left out and listed in `ignored`.
+    """
+
+    def __init__(self, topic, groups, ignored=()):
+        self.topic = topic
+        self.groups = tuple(sorted(set(tuple(sorted(set(group))) for group in groups)))
+        self.ignored = tuple(sorted(set(ignored)))
+
+    @classmethod
+    def parse(cls, topic, query):
+        try:
+            tokens = shlex.split(query)
+        except ValueError as e:
+            raise QueryError(str(e))
+
+        groups = []
+        ignored = []
+        group = None  # the group an OR joins, None when the previous term was left out on its own
+        key, negated, join = None, False, False
+        for token in tokens:
+            if key is None and token in ('OR', 'NOT'):
+                join = join or token == 'OR'
+                negated = negated or token == 'NOT'
+                continue
+
+            if key is None and token.startswith('-') and len(token) > 1:
+                negated, token = True, token[1:]
+
+            if key is not None:
+                value = token
+            elif token.endswith(':'):
+                key = token[:-1].lower()
+                continue
+            elif ':' in token:
+                key, value = token.split(':', 1)
+                key = key.lower()
+            else:
+                key, value = TEXT, token
+
+            if not join:
+                group = None
+            if key == TEXT or key in TOPIC_FIELDS[topic]:
+                if group is None:
+                    group = []
+                    groups.append(group)
+                group.append((negated, key, normalize(topic, key, value)))
+            else:
+                ignored.append(key)
+            key, negated, join = None, False, False
+
+        if key is not None:
+            raise QueryError('missing value for %s' % key)
+        if not groups:
+            raise QueryError('empty query')
+        return cls(topic, groups, ignored)
+
+    @property
+    def key(self):
+        """stable across spelling differences that do not change the result, e.g. term order or case"""
+        return hashlib.md5(ujson.dumps([self.topic, self.groups]).encode()).hexdigest()
+
+    @property
+    def model(self):
+        return Fingerprint if self.topic == 'host' else Website
+
+    def term_q(self, key, value):
+        if key == TEXT:
+            return Q(pk__in=self.model.objects.search(value).values('pk'))
+
+        if key == 'port':
+            ports = [int(port) for port in value.split('-')]
+            return Q(port__range=ports) if len(ports) == 2 else Q(port=ports[0])
+
+        if key == 'ip':
+            if '-' in value:
+                return Q(ip__range=value.split('-'))
+            if '/' in value:
+                return Q(ip__in_network=value)
+            return Q(ip=value)
+
+        return Q(**{TOPIC_FIELDS[self.topic][key]: value})
+
+    def queryset(self):
+        """the matching rows in display order, hosts are collapsed to their latest matching fingerprint"""
+        condition = Q()
+        words = []
+        for group in self.groups:
+            if len(group) == 1 and group[0][:2] == (False, TEXT):  # plain words share one full-text match
+                words.append(group[0][2])
+                continue
+
+            q = Q()
+            for negated, key, value in group:
+                term = self.term_q(key, value)
+                q |= ~term if negated else term
+            condition &= q
+
+        qs = self.model.objects.filter(condition)
+        if words:
+            qs = qs.search(' '.join(words))
+
+        if self.topic == 'host':
+            return qs.order_by('ip', '-timestamp').distinct('ip')
+
+        if any(key in ('app', 'ver') for group in self.groups for _, key, _ in group):
+            qs = qs.distinct()  # one page may match through several apps
+        return qs.order_by('-pk').prefetch_related('app_set')
+
+    def ids(self):
+        """
+        Primary keys of the first SEARCH_RESULT_LIMIT + 1 results in display order.
+        Cached per canonical query until the topic's data changes, so paging does not re-run the search.
+        """
+        version = stored_version(SEARCH_VERSION_KEY % self.topic)
+        cache_key = 'search:%s:%s:%s' % (self.topic, version, self.key)
+        ids = cache.get(cache_key)
+        if ids is None:
+            ids = list(self.queryset().values_list('pk', flat=True)[:SEARCH_RESULT_LIMIT + 1])
+            cache.set(cache_key, ids, getattr(settings, 'SEARCH_CACHE_TIMEOUT', 600))
+        return ids
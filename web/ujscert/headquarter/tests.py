@@ -1,7 +1,39 @@
-from django.db import connection
-from ujscert.headquarter.models import Agent, Fingerprint
-from django.test import TestCase, Client
-from django.test.utils import override_settings
+import gzip
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+import ujson
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from ujscert.headquarter.models import Agent, Fingerprint, FingerprintHistory, Host, Website, App, Alert, Property, \
+    PageBlob, WebsiteChange, Product, CpeProduct, agent_identities, refresh_facets, top_facets, owning_properties
+from ujscert.headquarter.ingest import index_websites, upsert_fingerprints
+from ujscert.cache import LRUCache
+from ujscert.headquarter.matcher import Matcher, cpe_product, inventory
+from ujscert.headquarter.query import Query, QueryError
+from ujscert.headquarter.utils import CursorPaginator, IngestQueue, KeyPool, key_pool
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, Client
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.test.utils import override_settings, CaptureQueriesContext
+
+
+def create_search_config():
+    with connection.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_ts_config WHERE cfgname = 'chinese'")
+        if cur.fetchone():
+            return
+
+        cur.execute('''CREATE EXTENSION zhparser;
+            CREATE TEXT SEARCH CONFIGURATION chinese (PARSER = zhparser);
+            ALTER TEXT SEARCH CONFIGURATION chinese ADD MAPPING FOR n,v,a,i,e,l WITH simple;''')
 
 
 class AuthTestCase(TestCase):
@@ -22,6 +54,57 @@ class AuthTestCase(TestCase):
         response = client.get(ping, HTTP_X_VERIFIED='SUCCESS', HTTP_X_CERT_DN='/CN=%s' % self.agent.uid.hex)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(DEBUG=False)
+    def test_identity_cache(self):
+        ping = '/hq/api/ping'
+        dn = '/CN=%s' % self.agent.uid.hex
+        agent_identities.clear()
+
+        self.client.get(ping, HTTP_X_VERIFIED='SUCCESS', HTTP_X_CERT_DN=dn)
+        with self.assertNumQueries(0):
+            response = self.client.get(ping, HTTP_X_VERIFIED='SUCCESS', HTTP_X_CERT_DN=dn)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ujson.loads(response.content.decode())['agent_cache']['hits'], agent_identities.hits)
+
+        with mock.patch.object(agent_identities, 'clear'):  # revoked in another process
+            Agent.objects.get(pk=self.agent.pk).delete()
+        response = self.client.get(ping, HTTP_X_VERIFIED='SUCCESS', HTTP_X_CERT_DN=dn)
+        self.assertEqual(response.status_code, 403)
+
+    def test_key_pool(self):
+        self.assertEqual(key_pool.size, 0)  # not in every process that saves an agent
+        pool = KeyPool(1)
+        pool.take()  # starts filling, this key is generated inline
+        for _ in range(100):
+            if pool.ready():
+                break
+            time.sleep(0.05)
+        self.assertEqual(pool.ready(), 1)
+
+    def test_lru(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+        cache.ttl = 0
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_enroll(self):
+        with tempfile.TemporaryDirectory() as out:
+            call_command('enroll_agents', '2', prefix='scanner', processes=1, out=out, stdout=StringIO())
+            agents = Agent.objects.filter(name__startswith='scanner-')
+            self.assertEqual(agents.count(), 2)
+            for agent in agents:
+                with open(os.path.join(out, agent.uid.hex + '.crt')) as f:
+                    self.assertEqual(f.read(), agent.x509_cert)
+                self.assertIn('PRIVATE KEY', agent.x509_key)
+
     @override_settings(DEBUG=True)
     def test_auth_debug(self):
         client = Client()
@@ -34,10 +117,7 @@ class AuthTestCase(TestCase):
 
 class SearchTestCase(TestCase):
     def setUp(self):
-        with connection.cursor() as cur:
-            cur.execute('''CREATE EXTENSION zhparser;
-                CREATE TEXT SEARCH CONFIGURATION chinese (PARSER = zhparser);
-                ALTER TEXT SEARCH CONFIGURATION chinese ADD MAPPING FOR n,v,a,i,e,l WITH simple;''')
+        create_search_config()
 
     def test_search(self):
         ssh = {
@@ -51,3 +131,455 @@ class SearchTestCase(TestCase):
 
         Fingerprint(**ssh).save()
         self.assertEqual(Fingerprint.objects.search('SSH & Linux').count(), 1)
+
+    @override_settings(SEARCH_INDEX_DEFERRED=True)
+    def test_deferred_index(self):
+        for port in (22, 2222):
+            Fingerprint(ip='192.168.30.1', port=port, product='Dropbear sshd', banner='', raw='').save()
+
+        self.assertEqual(Fingerprint.objects.search('Dropbear').count(), 0)
+        self.assertEqual(Fingerprint.objects.update_dirty_search_fields(1), 1)
+        self.assertEqual(Fingerprint.objects.update_dirty_search_fields(10), 1)
+        self.assertEqual(Fingerprint.objects.update_dirty_search_fields(10), 0)
+        self.assertEqual(Fingerprint.objects.search('Dropbear').count(), 2)
+
+        fingerprint = Fingerprint.objects.get(port=22)  # loaded clean, as the admin does
+        fingerprint.product = 'OpenSSH'
+        fingerprint.save()
+        self.assertEqual(Fingerprint.objects.update_dirty_search_fields(10), 1)
+        self.assertEqual(Fingerprint.objects.search('OpenSSH').count(), 1)
+
+
+@override_settings(DEBUG=True)
+class IndexWebTestCase(TestCase):
+    def setUp(self):
+        create_search_config()
+
+    def test_bulk_index(self):
+        page = {
+            'domain': 'www.ujs.edu.cn', 'ip': '202.195.160.1', 'port': 80,
+            'url': 'http://www.ujs.edu.cn/', 'title': '', 'html': '<title>Jiangsu University</title>',
+            'rawHeader': 'Server: nginx', 'headers': {'Server': 'nginx'}, 'apps': ['nginx', 'jQuery'],
+            'detail': {'nginx': {'version': '1.4.6', 'versions': ['1.4.6']}, 'jQuery': {'version': None}},
+        }
+        broken = dict(page, ip='not an ip')
+
+        response = Client().post('/hq/api/index/web', ujson.dumps([page, broken, page]),
+                                 content_type='application/json')
+        results = ujson.loads(response.content.decode())['results']
+
+        self.assertEqual([result['status'] for result in results], ['ok', 'fail', 'ok'])
+        self.assertIn('ip', results[1]['reason'])
+        self.assertEqual(Website.objects.count(), 1)  # the repeated page is the same version
+        self.assertEqual(results[2]['id'], results[0]['id'])
+        self.assertEqual(App.objects.filter(website_id=results[2]['id']).count(), 2)
+        self.assertEqual(Website.objects.get(pk=results[0]['id']).title, page['url'])
+        self.assertEqual(Website.objects.search('nginx').count(), 1)
+
+    def test_rescan(self):
+        page = {'domain': 'www.ujs.edu.cn', 'ip': '202.195.160.1', 'url': 'http://www.ujs.edu.cn/',
+                'html': '<title>Jiangsu University</title>', 'apps': ['nginx'], 'detail': {'nginx': {'version': '1.4'}}}
+
+        def index(*pages):
+            response = Client().post('/hq/api/index/web', ujson.dumps(pages), content_type='application/json')
+            return ujson.loads(response.content.decode())['results']
+
+        first, = index(page)
+        Website.objects.filter(pk=first['id']).update(last_seen=timezone.now() - timezone.timedelta(days=1))
+        with CaptureQueriesContext(connection) as queries:
+            again, = index(page)
+        self.assertEqual((again['id'], again['changed']), (first['id'], False))
+        self.assertGreater(Website.objects.get(pk=first['id']).last_seen, timezone.now() - timezone.timedelta(hours=1))
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('INSERT')])
+
+        upgraded, = index(dict(page, detail={'nginx': {'version': '1.6'}}))
+        self.assertTrue(upgraded['changed'])
+        self.assertEqual(Website.objects.filter(url=page['url']).count(), 2)
+        change = WebsiteChange.objects.get()
+        self.assertEqual((change.website_id, change.previous_id), (upgraded['id'], first['id']))
+
+    def test_page_blob(self):
+        page = {'domain': 'www.ujs.edu.cn', 'ip': '202.195.160.1', 'url': 'http://www.ujs.edu.cn/',
+                'html': '<title>Jiangsu University</title>', 'apps': ['nginx']}
+        for html in (page['html'], page['html'], '<title>Library</title>'):
+            Client().post('/hq/api/index/web', ujson.dumps([dict(page, html=html)]), content_type='application/json')
+        Website(domain='lib.ujs.edu.cn', ip='202.195.160.2', url='http://lib.ujs.edu.cn/', html='<p>Library</p>',
+                app_joint='nginx').save()
+
+        self.assertEqual(PageBlob.objects.count(), 3)
+        self.assertEqual(Website.objects.search('Jiangsu').count(), 1)
+        self.assertEqual(Website.objects.search('Library').count(), 2)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get('/hq/property/web/www.ujs.edu.cn'), 'Jiangsu University')
+        # the source is joined to the page rows, not fetched page by page
+        self.assertFalse([q for q in queries.captured_queries if 'FROM "headquarter_pageblob"' in q['sql']])
+
+
+@override_settings(DEBUG=True)
+class AlertFeedTestCase(TestCase):
+    def setUp(self):
+        create_search_config()
+
+    def post(self, alerts):
+        response = Client().post('/hq/api/index/feeds', ujson.dumps(alerts), content_type='application/json')
+        return ujson.loads(response.content.decode())
+
+    def test_batch(self):
+        alerts = [{'title': 'advisory %d' % i, 'url': 'http://example.com/%d' % i,
+                   'timestamp': '2016-04-01T00:00:00Z', 'source': 'cve'} for i in range(3)]
+        self.assertEqual(self.post(alerts)['new'], 3)
+
+        response = self.post(alerts + [dict(alerts[0], keywords=['ujs.edu.cn']), {'title': 'no url'}, alerts[1]])
+        self.assertEqual([response[key] for key in ('new', 'updated', 'duplicate', 'failed')], [0, 1, 4, 1])
+        self.assertEqual([result['status'] for result in response['results']], ['ok'] * 4 + ['fail', 'ok'])
+        self.assertEqual(Alert.objects.count(), 3)
+        self.assertEqual(Alert.objects.get(url=alerts[0]['url']).keywords, ['ujs.edu.cn'])
+
+        single = dict(alerts[0], url='http://example.com/single')
+        for new in (True, False):  # a resend is not an error
+            response = Client().put('/hq/api/index/feed', ujson.dumps(single), content_type='application/json')
+            self.assertEqual(ujson.loads(response.content.decode()), {'status': 'ok', 'new': new})
+
+    def test_backpressure(self):
+        alert = {'title': 'advisory 0', 'url': 'http://example.com/0', 'timestamp': '2016-04-01T00:00:00Z'}
+        body = ujson.dumps([alert])
+        queue = IngestQueue(workers=1, size=0)
+        with mock.patch('ujscert.headquarter.views.ingest_queue', queue), queue.admit():  # a batch being written
+            response = Client().post('/hq/api/index/feeds', body, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(queue.stats()['rejected'], 1)
+        self.assertFalse(Alert.objects.exists())
+
+        with override_settings(INGEST_MAX_BODY=len(body) - 1):
+            response = Client().post('/hq/api/index/feeds', body, content_type='application/json')
+        self.assertEqual(response.status_code, 413)
+        # chunked, without a length: the body would read as empty
+        response = Client().post('/hq/api/index/feeds', body, content_type='application/json', CONTENT_LENGTH='')
+        self.assertEqual(response.status_code, 411)
+        self.assertEqual(self.post([alert])['new'], 1)
+
+    def test_alert_page(self):
+        cache.clear()
+        User.objects.create_user('staff', password='password', is_staff=True)
+        self.client.login(username='staff', password='password')
+        alert = {'title': 'advisory 0', 'url': 'http://example.com/0', 'timestamp': '2016-04-01T00:00:00Z'}
+        self.post([alert])
+        self.assertContains(self.client.get('/hq/alerts'), 'advisory 0')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get('/hq/alerts'), 'advisory 0')
+        self.assertFalse([q for q in queries.captured_queries if 'headquarter_alert' in q['sql']])
+
+        self.post([dict(alert, title='advisory 1', url='http://example.com/1')])  # raw SQL, no signal
+        self.assertContains(self.client.get('/hq/alerts'), 'advisory 1')
+
+    def test_matcher(self):
+        matcher = Matcher(['nginx', 'PHP', 'Apache Tomcat', 'go'])
+        self.assertEqual(len(matcher), 3)  # too short to match safely
+        self.assertEqual(matcher.find('PHP-FPM and phpMyAdmin behind NGINX'), ['PHP', 'nginx'])
+        self.assertEqual(matcher.find('apache tomcat远程代码执行漏洞, apache tomcatx'), ['Apache Tomcat'])
+
+        matcher.add(['Tomcat', 'phpMyAdmin'])
+        self.assertEqual(matcher.find('apache tomcat and phpmyadmin'), ['Apache Tomcat', 'Tomcat', 'phpMyAdmin'])
+        matcher.add(['Apache', 'cat'])  # end on existing states, and become their suffix
+        text = 'apache tomcat, apache cat, phpmyadmin'
+        self.assertEqual(matcher.find(text), ['Apache', 'Apache Tomcat', 'Tomcat', 'cat', 'phpMyAdmin'])
+        self.assertEqual(matcher.find(text), Matcher(matcher._terms.values()).find(text))
+        self.assertEqual(cpe_product('cpe:/a:igor_sysoev:nginx_plus:1.4'), 'nginx plus')
+
+    def test_highlight(self):
+        upsert_fingerprints([{'ip': '202.195.160.1', 'port': 80, 'product': 'Microsoft IIS httpd', 'banner': '',
+                              'raw': '', 'cpes': ['cpe:/a:microsoft:iis:7.5']}])
+        inventory.matcher = Matcher()  # a process that did not ingest it reads the catalog
+        inventory.reload()
+        now = timezone.now().isoformat()
+        alerts = [{'title': 'IIS 7.5 远程代码执行漏洞', 'url': 'http://example.com/iis', 'timestamp': now},
+                  {'title': 'Exim overflow', 'url': 'http://example.com/exim', 'timestamp': now}]
+        self.post(alerts)
+
+        self.assertEqual(Alert.objects.get(url=alerts[0]['url']).keywords, ['iis'])
+        self.assertEqual(list(Alert.objects.filter(highlighted=True).values_list('url', flat=True)), [alerts[0]['url']])
+
+        index_websites([{'domain': 'mail.ujs.edu.cn', 'ip': '202.195.160.2', 'url': 'http://mail.ujs.edu.cn/',
+                         'apps': ['Exim'], 'detail': {'Exim': {}}}])
+        call_command('match_alerts', stdout=StringIO())
+        self.assertEqual(Alert.objects.filter(highlighted=True).count(), 2)
+
+        inventory.matcher = Matcher()  # resent by a worker whose inventory has not picked up Exim yet
+        resent = dict(alerts[1], keywords=['overflow'])
+        self.assertEqual(self.post([resent])['updated'], 1)
+        exim = Alert.objects.get(url=alerts[1]['url'])
+        self.assertEqual((exim.keywords, exim.highlighted), (['Exim', 'overflow'], True))
+
+
+@override_settings(DEBUG=True)
+class IndexHostTestCase(TestCase):
+    def setUp(self):
+        create_search_config()
+
+    def index(self, items):
+        response = Client().post('/hq/api/index/host', ujson.dumps(items), content_type='application/json')
+        return ujson.loads(response.content.decode())['results']
+
+    def test_upsert(self):
+        ssh = {'ip': '10.0.0.1', 'port': 22, 'service': 'ssh', 'product': 'OpenSSH', 'version': '6.6',
+               'banner': 'SSH-2.0-OpenSSH_6.6', 'raw': '', 'cpes': ['a:openbsd:openssh:6.6']}
+        http = {'ip': '10.0.0.1', 'port': 80, 'service': 'http', 'product': 'nginx', 'banner': '', 'raw': ''}
+
+        first = self.index([ssh, http, dict(http, port='http'), dict(http, port=81, cpes=None),
+                            dict(http, port=82, cpes='a:nginx:nginx'), dict(http, port=83, cpes=['x' * 129])])
+        self.assertEqual([result['status'] for result in first], ['ok', 'ok'] + ['fail'] * 4)
+        self.assertIn('cpes', first[4]['reason'])
+
+        second = self.index([dict(ssh, version='7.2'), dict(ssh, version='7.4'), http])
+        self.assertEqual([result['id'] for result in second], [first[0]['id'], first[0]['id'], first[1]['id']])
+
+        self.assertEqual(Fingerprint.objects.count(), 2)
+        self.assertEqual(Fingerprint.objects.get(pk=first[0]['id']).version, '7.4')
+        self.assertEqual(Fingerprint.objects.search('OpenSSH').count(), 1)
+        self.assertTrue(CpeProduct.objects.filter(name='openssh').exists())
+        self.assertEqual(sorted(FingerprintHistory.objects.values_list('port', 'version')), [(22, '6.6'), (80, '')])
+
+    def test_catalog(self):
+        self.index([{'ip': '10.0.0.3', 'port': port, 'product': 'OpenSSH', 'banner': '', 'raw': '',
+                     'cpes': ['cpe:/a:openbsd:openssh:7.4', 'cpe:/a:apache:http_server']} for port in (22, 2222)])
+        index_websites([{'domain': 'www.ujs.edu.cn', 'ip': '10.0.0.3', 'url': 'http://www.ujs.edu.cn/',
+                         'apps': ['nginx', 'OpenSSH'], 'detail': {'nginx': {}, 'OpenSSH': {}}}])
+        self.assertEqual(Product.objects.get(name='OpenSSH').occurrences, 3)
+
+        response = Client().get('/hq/api/apps')
+        catalog = ujson.loads(response.content.decode())
+        self.assertEqual(sorted(catalog['apps']), ['OpenSSH', 'nginx'])  # not 'openssh' or 'http server' of the cpes
+        self.assertEqual(Client().get('/hq/api/apps', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        Product.objects.filter(name='nginx').update(first_seen=timezone.now() - timezone.timedelta(days=1))
+        delta = Client().get('/hq/api/apps', {'since': catalog['latest']})
+        self.assertEqual(ujson.loads(delta.content.decode())['apps'], ['OpenSSH'])
+        self.assertNotEqual(delta['ETag'], response['ETag'])
+
+        # inserted by a transaction that started before that poll and committed after it
+        latest = ujson.loads(delta.content.decode())['latest']
+        Product.objects.create(name='Exim', first_seen=parse_datetime(latest) - timezone.timedelta(seconds=30),
+                               last_seen=timezone.now(), occurrences=1)
+        later = ujson.loads(Client().get('/hq/api/apps', {'since': latest}).content.decode())
+        self.assertIn('Exim', later['apps'])
+        self.assertNotIn('nginx', later['apps'])
+        self.assertEqual(later['latest'], latest)
+        self.assertEqual(Client().get('/hq/api/apps', {'since': 'yesterday'}).status_code, 400)
+
+    def test_host_summary(self):
+        self.index([{'ip': '10.0.0.2', 'port': port, 'service': service, 'banner': '', 'raw': ''}
+                    for port, service in ((443, 'https'), (22, 'ssh'))])
+        host = Host.objects.get(ip='10.0.0.2')
+        self.assertEqual((host.ports, host.services), ([22, 443], ['ssh', 'https']))
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.assertContains(self.client.get('/hq/property/host/10.0.0.2'), 'ssh')
+        self.assertEqual(self.client.get('/hq/property/host/10.0.0.3').status_code, 404)
+
+        Fingerprint.objects.get(ip='10.0.0.2', port=443).delete()
+        self.assertEqual(Host.objects.get(ip='10.0.0.2').ports, [22])
+        Fingerprint.objects.get(ip='10.0.0.2', port=22).delete()
+        self.assertFalse(Host.objects.filter(ip='10.0.0.2').exists())
+
+
+class ConcurrentIngestTestCase(TransactionTestCase):
+    def setUp(self):
+        create_search_config()
+
+    def test_host_ports(self):
+        item = {'ip': '10.0.0.4', 'port': 22, 'service': 'ssh', 'banner': '', 'raw': ''}
+        written = threading.Event()
+
+        def ingest():  # another worker, its transaction still open while we ingest
+            try:
+                with transaction.atomic():
+                    upsert_fingerprints([item])
+                    written.set()
+                    time.sleep(0.5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=ingest)
+        thread.start()
+        written.wait(5)
+        upsert_fingerprints([dict(item, port=80, service='http')])
+        thread.join()
+        self.assertEqual(Host.objects.get(ip='10.0.0.4').ports, [22, 80])
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        create_search_config()
+        User.objects.create_user('staff', password='password', is_staff=True)
+        for i in range(5):
+            Fingerprint(ip='10.0.0.%d' % i, port=22, service='ssh', product='OpenSSH', banner='', raw='').save()
+
+        self.client = Client()
+        self.client.login(username='staff', password='password')
+
+    def export(self, fmt):
+        response = self.client.get('/hq/property/export/', {'q': 'port:22', 't': 'host', 'f': fmt})
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_csv(self):
+        lines = self.export('csv').decode().splitlines()
+        self.assertEqual(lines[0], 'ip,port,service,product,version,os')
+        self.assertEqual(lines[1], '10.0.0.0,22,ssh,OpenSSH,,')
+        self.assertEqual(len(lines), 6)
+
+    def test_search_paging(self):
+        Fingerprint(ip='10.0.0.0', port=2222, service='ssh', banner='', raw='').save()
+        ips = []
+        params = {'q': 'service:ssh', 't': 'host'}
+        for _ in range(3):
+            response = self.client.get('/hq/property/search/', params)
+            page = response.context['items']
+            ips += [item.ip for item in page]
+            if not page.has_next():
+                break
+            params = QueryDict(page.next_query)
+
+        self.assertEqual(response.context['count'], 5)
+        self.assertEqual(ips, ['10.0.0.%d' % i for i in range(5)])
+        self.assertEqual(self.client.get('/hq/alerts').status_code, 200)
+        self.assertEqual(self.client.get('/review/all/all').status_code, 200)
+
+    def test_jsonl_gzip(self):
+        lines = gzip.decompress(self.export('jsonl.gz')).decode().splitlines()
+        self.assertEqual([ujson.loads(line)['ip'] for line in lines], ['10.0.0.%d' % i for i in range(5)])
+
+
+class QueryTestCase(TestCase):
+    def setUp(self):
+        create_search_config()
+        cache.clear()
+        for ip, port, product in (('10.0.0.1', 22, 'OpenSSH'), ('10.0.0.2', 8080, 'Tomcat'),
+                                  ('10.1.0.1', 8443, 'nginx'), ('192.168.0.1', 80, 'nginx')):
+            Fingerprint(ip=ip, port=port, service='http', product=product, banner='', raw='').save()
+
+    def ips(self, query):
+        return [item.ip for item in Query.parse('host', query).queryset()]
+
+    def test_canonical(self):
+        self.assertEqual(Query.parse('host', 'product:NGINX port:9000-8000').key,
+                         Query.parse('host', 'port:8000-9000 product: nginx').key)
+        self.assertNotEqual(Query.parse('host', 'product:nginx').key, Query.parse('web', 'app:nginx').key)
+        for query in ('', 'colour:red', 'port:http', 'ip:10.0.0.0/33', 'product:'):
+            self.assertRaises(QueryError, Query.parse, 'host', query)
+
+    def test_unknown_fields(self):
+        Fingerprint.objects.filter(ip='10.1.0.1').update(version='1.4')
+        self.assertEqual(self.ips('product:nginx ver:1.4'), ['10.1.0.1'])
+        self.assertEqual(Query.parse('host', 'product:nginx ver:1.4').ignored, ())
+
+        search = Query.parse('web', 'product:nginx ver:1.4')
+        self.assertEqual((search.ignored, search.key), (('product',), Query.parse('web', 'ver:1.4').key))
+        self.assertEqual(Query.parse('host', 'port:22 colour:red OR port:80').key,
+                         Query.parse('host', 'port:22 port:80').key)
+        self.assertEqual(Query.parse('host', 'port:22 OR colour:red OR port:80').key,
+                         Query.parse('host', 'port:22 OR port:80').key)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.assertContains(self.client.get('/hq/property/search/', {'q': 'product:nginx ver:1.4', 't': 'web'}),
+                            '不支持的字段: product')
+
+    def test_operators(self):
+        self.assertEqual(self.ips('ip:10.0.0.0/8'), ['10.0.0.1', '10.0.0.2', '10.1.0.1'])
+        self.assertEqual(self.ips('port:8000-9000'), ['10.0.0.2', '10.1.0.1'])
+        self.assertEqual(self.ips('product:nginx OR port:22'), ['10.0.0.1', '10.1.0.1', '192.168.0.1'])
+        self.assertEqual(self.ips('product:nginx NOT ip:10.0.0.0/8'), ['192.168.0.1'])
+        self.assertEqual(self.ips('-product:nginx ip:10.0.0.1-10.0.0.9'), ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(self.ips('tomcat OR openssh'), ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(list(Query.parse('web', 'app:nginx ver:1.4 OR ver:1.5 -port:8080').queryset()), [])
+
+    def test_department(self):
+        Property.objects.create(ip='10.0.0.0', network='10.0.0.0/8', name='campus', department='CS')
+        Property.objects.create(ip='10.1.0.1', name='mail', department='Math')
+
+        self.assertEqual(self.ips('dept:cs'), ['10.0.0.1', '10.0.0.2', '10.1.0.1'])
+        self.assertEqual(self.ips('dept:math OR ip:192.168.0.0/16'), ['10.1.0.1', '192.168.0.1'])
+        owners = owning_properties(['10.0.0.1', '10.1.0.1', '192.168.0.1'])
+        self.assertEqual({ip: owner.name for ip, owner in owners.items()}, {'10.0.0.1': 'campus', '10.1.0.1': 'mail'})
+
+    def test_ipv6_host(self):
+        Fingerprint(ip='2001:da8::1', port=22, banner='', raw='').save()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.assertEqual(self.client.get('/hq/property/host/2001:da8::1').status_code, 200)
+        self.assertEqual(self.client.get('/hq/property/host/2001:da8:::1').status_code, 404)
+        self.assertEqual(self.ips('ip:2001:da8::/32'), ['2001:da8::1'])
+
+    def test_cached_ids(self):
+        query = Query.parse('host', 'product:nginx')
+        self.assertEqual(len(query.ids()), 2)
+        with self.assertNumQueries(0):
+            query.ids()
+
+        Fingerprint(ip='10.2.0.1', port=80, product='nginx', banner='', raw='').save()
+        self.assertEqual(len(query.ids()), 3)
+
+
+class FacetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i, (port, product) in enumerate([(22, 'OpenSSH'), (22, 'OpenSSH'), (80, 'nginx'), (443, '')]):
+            Fingerprint(ip='10.0.1.%d' % i, port=port, product=product, banner='', raw='').save()
+
+    def test_top_facets(self):
+        self.assertEqual(refresh_facets(), 3 + 1 + 1 + 1 + 3)
+        facets = top_facets(2)
+        self.assertEqual(facets['port'], [('22', 2), ('443', 1)])
+        self.assertEqual(facets['product'], [('OpenSSH', 2), ('', 1)])
+        self.assertEqual(facets['app'], [])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(top_facets(10)['port'], [('22', 2), ('443', 1), ('80', 1)])
+
+    def test_search_home(self):
+        refresh_facets()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.assertContains(self.client.get('/hq/property/search'), 'q=product:%22OpenSSH%22')
+
+
+class CursorPaginatorTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for i in range(7):  # pairs of alerts share a timestamp, the pk breaks the tie
+            Alert(title='alert %d' % i, url='http://example.com/%d' % i,
+                  timestamp=now - timezone.timedelta(minutes=i // 2)).save()
+
+        self.paginator = CursorPaginator(Alert.objects.all(), ('-timestamp', '-pk'), 3)
+
+    def titles(self, page):
+        return [alert.title for alert in page]
+
+    def test_walk(self):
+        first = self.paginator.page(QueryDict('q=x'))
+        self.assertEqual(len(first), 3)
+        self.assertFalse(first.has_previous())
+
+        second = self.paginator.page(QueryDict(first.next_query))
+        third = self.paginator.page(QueryDict(second.next_query))
+        self.assertIn('q=x', second.next_query)
+        self.assertFalse(third.has_next())
+
+        seen = self.titles(first) + self.titles(second) + self.titles(third)
+        expected = [alert.title for alert in Alert.objects.order_by('-timestamp', '-pk')]
+        self.assertEqual(seen, expected)
+
+        back = self.paginator.page(QueryDict(third.previous_query))
+        self.assertEqual(self.titles(back), self.titles(second))
+        self.assertTrue(back.has_previous())
+        self.assertEqual(self.titles(self.paginator.page(QueryDict(back.previous_query))), self.titles(first))
+
+    def test_bad_cursor(self):
+        self.assertEqual(len(self.paginator.page(QueryDict('after=garbage'))), 3)
@@ -1,20 +1,93 @@
-import shlex
+import base64
+import os
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
 
+import ujson
 from OpenSSL import crypto
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.urlresolvers import reverse_lazy
+from django.db import connections, transaction
+from django.db.models import Q
 
 
-def gen_cert(agent_uuid):
-    with open(settings.CA_CERT) as f:
+@lru_cache(maxsize=4)
+def _load_ca(cert_path, key_path, passphrase):
+    with open(cert_path) as f:
         ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
 
-    with open(settings.CA_KEY) as f:
-        ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read(), settings.CA_KEY_PASSPHRASE)
+    with open(key_path) as f:
+        ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read(), passphrase)
 
+    return ca_cert, ca_key
+
+
+def load_ca():
+    """the CA certificate and key, read and parsed once per process"""
+    return _load_ca(settings.CA_CERT, settings.CA_KEY, settings.CA_KEY_PASSPHRASE)
+
+
+def gen_key():
     key = crypto.PKey()
     key.generate_key(crypto.TYPE_RSA, 2048)
+    return key
+
+
+class KeyPool(object):
+    """
+    RSA keys generated ahead of time by a background thread, so issuing a certificate does not wait for one.
+    The thread starts on first use and tops the pool up to `size` keys, an empty pool generates inline.
+    The thread and the unused private keys stay for the life of the process: only enable it (CERT_KEY_POOL_SIZE)
+    in the process that issues certificates.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._keys = queue.Queue(maxsize=max(size, 1))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _fill(self):
+        while True:
+            self._keys.put(gen_key())  # blocks while the pool is full
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():  # not started yet, or started in a parent before fork
+                self._thread = threading.Thread(target=self._fill, name='cert-key-pool', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def ready(self):
+        """keys waiting in the pool"""
+        return self._keys.qsize()
+
+    def take(self):
+        if self.size <= 0:
+            return gen_key()
+
+        self._start()
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return gen_key()
+
+
+key_pool = KeyPool(getattr(settings, 'CERT_KEY_POOL_SIZE', 0))
+
+
+def gen_cert(agent_uuid, key=None):
+    """issue a client certificate for an agent, returns (cert, key) as PEM, the key comes from key_pool by default"""
+    ca_cert, ca_key = load_ca()
+
+    if key is None:
+        key = key_pool.take()
 
     cert = crypto.X509()
     # cert.get_subject().C = "IN"
@@ -35,34 +108,248 @@ def gen_cert(agent_uuid):
         crypto.dump_privatekey(crypto.FILETYPE_PEM, key).decode()
 
 
+def issue_cert(agent_uuid):
+    """gen_cert with a freshly generated key, for worker processes that have no key pool of their own"""
+    return gen_cert(agent_uuid, gen_key())
+
+
 def parse_dn(dn):
     return dict((part.split('=') for part in dn.split('/') if '=' in part))
 
 
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue(object):
+    """
+    Admission control for the agent uploads of one process. At most `workers` batches are written to the database
+    at a time and at most `size` more requests wait, reading their bodies meanwhile. Beyond that admit() raises
+    QueueFull at once, before the body is read, so a flood of uploads is turned away instead of piling up.
+    """
+
+    def __init__(self, workers, size):
+        self.workers = workers
+        self.size = size
+        self.pending = 0  # admitted and not done: reading, waiting for a worker or being written
+        self.admitted = self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        with self._lock:
+            if self.pending >= self.workers + self.size:
+                self.rejected += 1
+                raise QueueFull
+            self.pending += 1
+            self.admitted += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    @contextmanager
+    def worker(self):
+        with self._slots:
+            yield
+
+    def stats(self):
+        return {'workers': self.workers, 'size': self.size, 'pending': self.pending,
+                'admitted': self.admitted, 'rejected': self.rejected}
+
+
+def read_body(request, limit, chunk_size=64 * 1024):
+    """
+    The request body, read `chunk_size` bytes at a time so a slow upload only holds its own (green) thread.
+    ValueError if it is longer than `limit` bytes, from Content-Length when given.
+    """
+    if int(request.META.get('CONTENT_LENGTH') or 0) > limit:
+        raise ValueError('request body larger than %d bytes' % limit)
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            return b''.join(chunks)
+
+        size += len(chunk)
+        if size > limit:
+            raise ValueError('request body larger than %d bytes' % limit)
+        chunks.append(chunk)
+
+
 staff_required = staff_member_required(login_url=reverse_lazy('login'))
 
 
-def parse_query(query):
-    tokens = shlex.split(query)
-    dsl = {'search': []}
-    key = ''
-    for token in tokens:
-        if token.endswith(':'):
-            key = token[:-1]
+def iter_rows(qs, chunk_size=2000):
+    """
+    Iterate over the rows of a values_list() queryset through a server-side (named) cursor,
+    so no more than `chunk_size` rows are held in memory whatever the size of the result.
+    """
+    sql, params = qs.query.sql_with_params()
+    connection = connections[qs.db]
+
+    with transaction.atomic(using=qs.db):  # named cursors only live inside a transaction
+        cursor = connection.connection.cursor(name='iter_%s' % uuid.uuid4().hex)
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+
+class CursorPage(object):
+    def __init__(self, items, params, next_cursor=None, previous_cursor=None):
+        self.items = items
+        self.params = params
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def _query(self, key, cursor):
+        params = self.params.copy()
+        for name in ('after', 'before', 'page'):
+            params.pop(name, None)
+        params[key] = cursor
+        return params.urlencode()
+
+    @property
+    def next_query(self):
+        return self._query('after', self.next_cursor)
+
+    @property
+    def previous_query(self):
+        return self._query('before', self.previous_cursor)
+
+
+class CursorPaginator(object):
+    """
+    Keyset pagination. A page is addressed by the sort key of the row it starts after (or ends before)
+    instead of an OFFSET, so page N costs the same index scan as page 1.
+
+    `keys` must be a unique ordering, e.g. ('-timestamp', '-pk').
+    """
+
+    def __init__(self, queryset, keys, per_page):
+        self.queryset = queryset
+        self.keys = keys
+        self.per_page = per_page
+
+    @staticmethod
+    def encode(values):
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+        return base64.urlsafe_b64encode(ujson.dumps(values).encode()).decode()
+
+    def decode(self, cursor):
+        try:
+            values = ujson.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (ValueError, TypeError, UnicodeError):
+            return None
+
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            return None
+        return values
+
+    def _seek(self, values, forward):
+        """rows strictly after (forward) or before the given key values"""
+        condition = Q()
+        for i, key in enumerate(self.keys):
+            descending = key.startswith('-')
+            lookup = 'lt' if descending == forward else 'gt'
+            q = Q(**{'%s__%s' % (key.lstrip('-'), lookup): values[i]})
+            for prev_key, value in zip(self.keys[:i], values):
+                q &= Q(**{prev_key.lstrip('-'): value})
+            condition |= q
+        return condition
+
+    def _key(self, item):
+        return self.encode([getattr(item, key.lstrip('-')) for key in self.keys])
+
+    def page(self, params):
+        after = self.decode(params.get('after', ''))
+        before = None if after else self.decode(params.get('before', ''))
+
+        if before is None:
+            qs = self.queryset.order_by(*self.keys)
+            if after:
+                qs = qs.filter(self._seek(after, True))
         else:
-            if ':' in token:
-                key, word = token.split(':', 1)
-                dsl[key] = word
-            elif key:
-                dsl[key] = token or ''
-            else:
-                dsl['search'].append(token)
+            reverse = tuple(key[1:] if key.startswith('-') else '-' + key for key in self.keys)
+            qs = self.queryset.order_by(*reverse).filter(self._seek(before, False))
 
-            key = ''
+        items = list(qs[:self.per_page + 1])
+        more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if before is not None:
+            items.reverse()
 
-    if key:
-        dsl[key] = ''
+        if before is None:
+            has_next, has_previous = more, after is not None
+        else:
+            has_next, has_previous = True, more
+
+        page = CursorPage(items, params)
+        if items and has_next:
+            page.next_cursor = self._key(items[-1])
+        if items and has_previous:
+            page.previous_cursor = self._key(items[0])
+        return page
+
+
+class IdListPaginator(CursorPaginator):
+    """
+    Pages through a precomputed list of primary keys, e.g. a cached search result, fetching only the page's rows.
+    Cursors name the pk a page starts after (or ends before), like CursorPaginator's with keys=('pk',).
+    """
 
-    return dsl
+    def __init__(self, ids, queryset, per_page):
+        super(IdListPaginator, self).__init__(queryset, ('pk',), per_page)
+        self.ids = ids
 
+    def _index(self, cursor):
+        values = self.decode(cursor)
+        try:
+            return self.ids.index(values[0]) if values else None
+        except ValueError:  # gone from a newer result, start over
+            return None
+
+    def page(self, params):
+        after = self._index(params.get('after', ''))
+        before = None if after is not None else self._index(params.get('before', ''))
+
+        if after is not None:
+            start = after + 1
+        elif before is not None:
+            start = max(before - self.per_page, 0)
+        else:
+            start = 0
+        end = before if before is not None else start + self.per_page
 
+        ids = self.ids[start:end]
+        rows = self.queryset.in_bulk(ids)
+        page = CursorPage([rows[pk] for pk in ids if pk in rows], params)
+        if ids and end < len(self.ids):
+            page.next_cursor = self.encode([ids[-1]])
+        if ids and start > 0:
+            page.previous_cursor = self.encode([ids[0]])
+        return page
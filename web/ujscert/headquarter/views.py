@@ -1,36 +1,50 @@
 import csv
+import hashlib
 import ujson
+import zlib
+from ipaddress import ip_address
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.db import IntegrityError
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, Http404
-from django.shortcuts import render, redirect
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, Http404, StreamingHttpResponse
+from django.db.models import Count, Max
+from django.shortcuts import render, redirect, get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import available_attrs
 from django.utils.six import wraps
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_GET, require_POST, require_http_methods
-from ujscert.headquarter.utils import staff_required, parse_dn, parse_query
-from ujscert.headquarter.models import Agent, Fingerprint, Website, App, Alert
+from django.views.decorators.http import require_GET, require_POST, require_http_methods, etag
+from ujscert.cache import cache_aside
+from ujscert.headquarter.ingest import index_websites, upsert_fingerprints, insert_alerts
+from ujscert.headquarter.query import Query, QueryError, SEARCH_RESULT_LIMIT
+from ujscert.headquarter.utils import staff_required, iter_rows, CursorPaginator, IdListPaginator, IngestQueue, \
+    QueueFull, read_body
+from ujscert.headquarter.models import Fingerprint, Website, Alert, Host, Product, identify_agent, agent_identities, \
+    top_facets, owning_properties
 
 
+ALERT_PAGE_TIMEOUT = 600
+FACET_TOP_K = 30  # most frequent values listed per facet on search_home
+# large columns no list renders, rows fetched for display skip them; the page source lives in PageBlob
+LIST_DEFERRED = {
+    'host': ('search_index', 'raw'),
+    'web': ('search_index', 'headers'),
+}
+
+ingest_queue = IngestQueue(getattr(settings, 'INGEST_WORKERS', 2), getattr(settings, 'INGEST_QUEUE_SIZE', 50))
+
 
 def api(func):
     @wraps(func, assigned=available_attrs(func))
     def decorator(request, *args, **kwargs):
         if not getattr(settings, 'DEBUG', False):  # production
             if request.META.get('HTTP_X_VERIFIED') == 'SUCCESS':
-                cert_dn = request.META.get('HTTP_X_CERT_DN')
-                cert_info = parse_dn(cert_dn)
-                try:
-                    agent = Agent.objects.get(uid=cert_info.get('CN', ''))
-                except ValueError:
-                    raise PermissionDenied
-                except Agent.DoesNotExist:
+                uid = identify_agent(request.META.get('HTTP_X_CERT_DN', ''))
+                if uid is None:
                     raise PermissionDenied
 
-                request.META['UID'] = agent.uid
+                request.META['UID'] = uid
             else:
                 return HttpResponse('Unauthorized', status=401)
 
@@ -39,18 +53,53 @@ def api(func):
     return decorator
 
 
+def ingest_api(func):
+    """
+    For the agent upload endpoints: the request takes its place in the process's ingest queue, or gets a 429 with
+    Retry-After when the queue is full. The body is read in chunks while waiting, then func(request, body) runs
+    once one of the INGEST_WORKERS is free. Uploads must give a Content-Length (411 otherwise): WSGI reads a body
+    without one, e.g. chunked and passed on unbuffered by nginx, as empty.
+    """
+    @wraps(func, assigned=available_attrs(func))
+    def decorator(request, *args, **kwargs):
+        if not request.META.get('CONTENT_LENGTH'):
+            return HttpResponse('Content-Length required', status=411)
+
+        try:
+            with ingest_queue.admit():
+                try:
+                    body = read_body(request, getattr(settings, 'INGEST_MAX_BODY', 32 * 1024 * 1024))
+                except ValueError as e:
+                    return HttpResponse(str(e), status=413)
+
+                with ingest_queue.worker():
+                    return func(request, body, *args, **kwargs)
+
+        except QueueFull:
+            response = HttpResponse('ingest queue full', status=429)
+            response['Retry-After'] = getattr(settings, 'INGEST_RETRY_AFTER', 5)
+            return response
+
+    return decorator
+
+
 @api
 @csrf_exempt
 @require_http_methods(['PUT'])
-def index_alert_view(request):
+@ingest_api
+def index_alert_view(request, body):
+    return put_alert(body)
+
+
+def put_alert(body):
+    """a single alert, a resend of a known url is not an error"""
     try:
-        data = ujson.loads(request.body)
-        Alert(**data).save()
+        item = ujson.loads(body)
     except ValueError as e:
         return HttpResponseBadRequest(e)
 
-    response = {'status': 'ok'}
-    return JsonResponse(response)
+    _, (result,) = insert_alerts([item])
+    return JsonResponse(result)
 
 
 @api
@@ -62,6 +111,8 @@ def pong_api_view(request):
     response = {
         'headers': headers,
         'pong': 'You know, for indexing',
+        'agent_cache': agent_identities.stats(),
+        'ingest_queue': ingest_queue.stats(),
     }
     return JsonResponse(response)
 
@@ -69,121 +120,183 @@ def pong_api_view(request):
 @api
 @csrf_exempt
 @require_POST
-def index_web_api_view(request):
+@ingest_api
+def index_web_api_view(request, body):
     try:
-        data = ujson.loads(request.body)
+        data = ujson.loads(body)
     except ValueError as e:
         return HttpResponseBadRequest(e)
 
     if type(data) is list and len(data):
-        keys = ['domain', 'ip', 'port', 'url', 'headers', 'html', 'title']
-
-        for item in data:
-            kwargs = {key: item.get(key, '') for key in keys}
-            kwargs['raw_headers'] = item.get('rawHeader')
-            kwargs['app_joint'] = '/'.join(item.get('apps', []))
-
-            if not kwargs['title']:
-                kwargs['title'] = kwargs['url']
-
-            website = Website(**kwargs)
-            website.save()
-
-            if 'detail' in item:
-                for name, app in item['detail'].items():
-                    App(app=name, ver=app.get('version'),
-                        website=website, versions=app.get('versions')).save()
-
-        return JsonResponse({'status': 'ok'})
+        results = index_websites(data)
+        return JsonResponse({'status': 'ok', 'results': results})
     return JsonResponse({'status': 'fail', 'reason': 'invalid input'})
 
 
 @api
 @csrf_exempt
 @require_POST
-def index_host_api_view(request):
+@ingest_api
+def index_host_api_view(request, body):
     try:
-        data = ujson.loads(request.body)
+        data = ujson.loads(body)
     except ValueError as e:
         return HttpResponseBadRequest(e)
 
     if type(data) is list and len(data):
-        for item in data:
-            Fingerprint(**item).save()
-        return JsonResponse({'status': 'ok'})
+        results = upsert_fingerprints(data)
+        return JsonResponse({'status': 'ok', 'results': results})
 
     return JsonResponse({'status': 'fail', 'reason': 'invalid input'})
 
 
+def parse_since(request):
+    """the optional `since` timestamp of a catalog poll, ValueError if malformed"""
+    value = request.GET.get('since')
+    if not value:
+        return None
+
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError('invalid since: %s' % value)
+    return since if timezone.is_aware(since) else timezone.make_aware(since)
+
+
+def catalog(since):
+    # first_seen is when the inserting transaction started, a name committed after a poll can be older than the
+    # `latest` that poll returned: look back further than the longest ingest transaction
+    products = Product.objects.all()
+    if since is None:
+        return products
+    overlap = timezone.timedelta(seconds=getattr(settings, 'CATALOG_SINCE_OVERLAP', 600))
+    return products.filter(first_seen__gte=since - overlap)
+
+
+def apps_etag(request):
+    """names are never removed from the catalog, its size and newest entry identify a response"""
+    try:
+        since = parse_since(request)
+    except ValueError:
+        return None
+
+    stats = catalog(since).aggregate(count=Count('pk'), latest=Max('first_seen'))
+    return hashlib.md5(('%s|%s|%s' % (since, stats['count'], stats['latest'])).encode()).hexdigest()
+
+
 @api
 @require_GET
+@etag(apps_etag)
 def apps_api_view(request):
-    products = [item['product'] for item in Fingerprint.objects.values('product').distinct()]
-    webapps = [item['app'] for item in App.objects.values('app').distinct()]
-    return JsonResponse({'apps': products + webapps})
+    """
+    Product and app names for agents to fingerprint. `since` (ISO 8601) limits the list to names first seen
+    at or after it, pass the returned `latest` to fetch only names added since this call. Names first seen up to
+    CATALOG_SINCE_OVERLAP seconds before `since` are listed again.
+    """
+    try:
+        since = parse_since(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(e)
+
+    products = list(catalog(since).order_by('first_seen', 'name').values_list('name', 'first_seen'))
+    latest = products[-1][1] if products else since
+    if since is not None and latest < since:  # only names from the overlap
+        latest = since
+    return JsonResponse({'apps': [name for name, _ in products], 'latest': latest})
 
 
 @api
 @require_http_methods(["PUT"])
 @csrf_exempt
-def feed_api_view(request):
+@ingest_api
+def feed_api_view(request, body):
+    return put_alert(body)
+
+
+@api
+@csrf_exempt
+@require_POST
+@ingest_api
+def index_feed_api_view(request, body):
     try:
-        item = ujson.loads(request.body)
-        Alert(**item).save()
+        data = ujson.loads(body)
     except ValueError as e:
         return HttpResponseBadRequest(e)
-    except IntegrityError:
-        pass
 
-    return JsonResponse({'status': 'ok'})
+    if type(data) is list and len(data):
+        counts, results = insert_alerts(data)
+        return JsonResponse(dict(counts, status='ok', results=results))
+    return JsonResponse({'status': 'fail', 'reason': 'invalid input'})
+
+
+@cache_aside(Alert, timeout=ALERT_PAGE_TIMEOUT)
+def alert_page(after, before):
+    """a page of the alert list, cached until an alert is written"""
+    paginator = CursorPaginator(Alert.objects.all(), ('-timestamp', '-pk'), 10)
+    return paginator.page({'after': after, 'before': before})
 
 
 @staff_required
 @require_GET
 def alert_view(request):
-    page = request.GET.get('page', 1)
-
-    qs = Alert.objects.all().order_by('-timestamp')
-    paginator = Paginator(qs, 10)
-    count = qs.count()
-
-    try:
-        items = paginator.page(page)
-    except PageNotAnInteger:
-        items = paginator.page(1)
-    except EmptyPage:
-        items = paginator.page(paginator.num_pages)
-
+    page = alert_page(request.GET.get('after', ''), request.GET.get('before', ''))
+    page.params = request.GET
     data = {
-        'items': items,
-        'count': count,
+        'items': page,
     }
 
     return render(request, 'alert_list.html', data)
 
 
-def search(query, topic):
-    dsl = parse_query(query)
-    if topic == 'host':
-        host_filters = ('os', 'port', 'product', 'service', 'ip', 'hostname', 'device')
-        filters = {'%s__iexact' % key: dsl[key] for key in host_filters if key in dsl}
-        qs = Fingerprint.objects.filter(**filters).order_by('ip', '-timestamp').distinct('ip')
+EXPORT_COLUMNS = {
+    'host': ('ip', 'port', 'service', 'product', 'version', 'os'),
+    'web': ('url', 'title'),
+}
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'csv.gz': 'application/gzip',
+    'jsonl.gz': 'application/gzip',
+}
+
+
+class Echo(object):
+    """file-like object for csv.writer, hands each written line back instead of buffering it"""
 
+    def write(self, value):
+        return value
+
+
+def export_lines(rows, columns, fmt):
+    if fmt.startswith('csv'):
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
     else:
-        app_filters = ('app', 'ver')
-        filters = {'app__%s__iexact' % key: dsl[key] for key in app_filters if key in dsl}
+        for row in rows:
+            yield ujson.dumps(dict(zip(columns, row))) + '\n'
 
-        if 'ip' in dsl:
-            filters['ip'] = dsl['ip']
 
-        qs = Website.objects.filter(**filters).prefetch_related('app_set')
+def export_chunks(lines, fmt, chunk_size=64 * 1024):
+    """group lines into chunks of about `chunk_size` bytes, gzip compressed for *.gz formats"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if fmt.endswith('.gz') else None
+    buf, size = [], 0
 
-    if len(dsl['search']):
-        keyword = ' '.join(dsl['search'])
-        qs = qs.search(keyword)
-        filters['keyword'] = keyword
+    for line in lines:
+        line = line.encode('utf8')
+        buf.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            chunk = b''.join(buf)
+            buf, size = [], 0
+            yield compressor.compress(chunk) if compressor else chunk
 
-    return qs, filters
+    chunk = b''.join(buf)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
 
 
 @staff_required
@@ -191,6 +304,7 @@ def search(query, topic):
 def export_view(request):
     query = request.GET.get('q')
     topic = request.GET.get('t')
+    fmt = request.GET.get('f', 'csv')
 
     if not query:
         return redirect('search_home')
@@ -198,22 +312,20 @@ def export_view(request):
     if topic not in ('host', 'web'):
         topic = 'host'
 
-    qs, filters = search(query, topic)
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="export.csv"'
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'csv'
 
-    writer = csv.writer(response)
+    try:
+        qs = Query.parse(topic, query).queryset()
+    except QueryError:
+        return render(request, 'search_error.html', {'query': query})
 
-    if topic == 'web':
-        writer.writerow(['url', 'title'])
-        for record in qs:
-            writer.writerow([record.url, record.title])
-
-    else:
-        writer.writerow(['ip', 'port', 'service', 'product', 'version', 'os'])
-        for record in qs:
-            writer.writerow([record.ip, record.port, record.service, record.product, record.version, record.os])
+    columns = EXPORT_COLUMNS[topic]
+    rows = iter_rows(qs.prefetch_related(None).values_list(*columns))
 
+    response = StreamingHttpResponse(export_chunks(export_lines(rows, columns, fmt), fmt),
+                                     content_type=EXPORT_FORMATS[fmt])
+    response['Content-Disposition'] = 'attachment; filename="export.%s"' % fmt
     return response
 
 
@@ -221,7 +333,6 @@ def export_view(request):
 @require_GET
 def search_view(request):
     query = request.GET.get('q')
-    page = request.GET.get('page')
     topic = request.GET.get('t')
 
     if not query:
@@ -230,25 +341,34 @@ def search_view(request):
     if topic not in ('host', 'web'):
         topic = 'host'
 
-    qs, filters = search(query, topic)
-    if not filters:
+    try:
+        search = Query.parse(topic, query)
+    except QueryError:
         return render(request, 'search_error.html', {'query': query})
 
-    paginator = Paginator(qs, 10)
-    count = qs.count()
+    ids = search.ids()
+    if topic == 'host':
+        rows = Fingerprint.objects.defer(*LIST_DEFERRED['host'])
+    else:
+        rows = Website.objects.defer(*LIST_DEFERRED['web']).prefetch_related('app_set')
 
-    try:
-        items = paginator.page(page)
-    except PageNotAnInteger:
-        items = paginator.page(1)
-    except EmptyPage:
-        items = paginator.page(paginator.num_pages)
+    items = IdListPaginator(ids[:SEARCH_RESULT_LIMIT], rows, 10).page(request.GET)
+    count, count_capped = min(len(ids), SEARCH_RESULT_LIMIT), len(ids) > SEARCH_RESULT_LIMIT
+
+    if topic == 'host':
+        hosts = {host.ip: host for host in Host.objects.filter(ip__in=[item.ip for item in items])}
+        owners = owning_properties(hosts)
+        for item in items:
+            item.host = hosts.get(item.ip)
+            item.owner = owners.get(item.ip)
 
     data = {
         'topic': topic,
         'query': query,
         'items': items,
         'count': count,
+        'count_capped': count_capped,
+        'ignored': search.ignored,
     }
 
     return render(request, 'search_result.html', data)
@@ -257,31 +377,35 @@ def search_view(request):
 @require_GET
 @staff_required
 def search_home_view(request):
-    data = {field + 's': Fingerprint.objects.values(field).distinct()
-            for field in ['port', 'product', 'os', 'device', 'service']}
-    data['webapps'] = App.objects.values('app').distinct()
+    facets = top_facets(FACET_TOP_K)
+    data = {field + 's': facets[field] for field in ['port', 'product', 'os', 'device', 'service']}
+    data['webapps'] = facets['app']
     return render(request, 'search_home.html', data)
 
 
 @require_GET
 @staff_required
 def host_view(request, ip):
-    results = Fingerprint.objects.filter(ip=ip).order_by('port', '-timestamp').distinct('port')
+    try:
+        ip = str(ip_address(ip))
+    except ValueError:
+        raise Http404()
+
+    host = get_object_or_404(Host, ip=ip)
     data = {
-        'ip': ip,
-        'ports': results,
+        'ip': host.ip,
+        'host': host,
+        'owner': owning_properties([host.ip]).get(host.ip),
+        'ports': Fingerprint.objects.filter(ip=host.ip).defer(*LIST_DEFERRED['host']).order_by('port'),
     }
 
-    if not results.count():
-        raise Http404()
-
     return render(request, 'host_detail.html', data)
 
 
 @require_GET
 @staff_required
 def web_view(request, domain):
-    pages = Website.objects.select_related().filter(
+    pages = Website.objects.select_related('page').defer('search_index').filter(
         domain=domain).order_by('url', '-timestamp').distinct('url').prefetch_related('app_set')
 
     data = {
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -86,11 +87,57 @@ DATABASES = {
         'NAME': os.environ.get('DB_ENV_POSTGRES_DB'),
         'USER': os.environ.get('DB_ENV_POSTGRES_USER'),
         'PASSWORD': os.environ.get('DB_ENV_POSTGRES_PASSWORD'),
-        'HOST': 'db',
-        'PORT': 5432,
+        'HOST': os.environ.get('DB_HOST', 'db'),  # 经 pgbouncer 连接时为 pgbouncer 的地址
+        'PORT': int(os.environ.get('DB_PORT', 5432)),
+        # 连接跨请求保持的最长秒数, 超过后在请求开始或结束时关闭, 0 为每个请求重新连接
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
     }
 }
 
+# 复用空闲超过 DB_HEALTH_CHECK_INTERVAL 秒的连接前先 SELECT 1, 已断开 (数据库或 pgbouncer 重启) 则重连, None 为不检查
+DB_HEALTH_CHECK_INTERVAL = 10
+
+# Cache
+# 两级缓存: default 为进程内 LRU (最多 LOCAL_MAX_ENTRIES 条, 每条最多 LOCAL_TIMEOUT 秒) + shared 共享缓存,
+# 写入直达 shared, 其他进程最多 LOCAL_TIMEOUT 秒后看到新值.
+# 设置 CACHE_LOCATION (memcached 地址, 如 memcached:11211, 需安装 python-memcached) 时 shared 使用外部缓存,
+# 否则退回本机文件缓存, 同一主机上的 worker 共享页面片段、数据版本号与命中统计
+
+if os.environ.get('CACHE_LOCATION'):
+    SHARED_CACHE = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['CACHE_LOCATION'],
+    }
+else:
+    SHARED_CACHE = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ujscert-cache')),
+        # 每次写入都会数一遍目录, 超过 MAX_ENTRIES 个文件时随机删除三分之一 (数据版本号与统计计数也会丢), 默认 300 太小
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 100000))},
+    }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'ujscert.cache.TieredCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 5,
+        },
+    },
+    'shared': SHARED_CACHE,
+}
+
+# 会话读写经 shared 缓存并落库, 退出登录对所有进程立即生效
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'shared'
+
+# 可用 ujscert.cache.cache_aside 缓存查询结果的模型, 这些模型保存或删除时 (任何进程) 其缓存失效:
+# 写入的进程立即失效, 其他进程本地缓存的版本号最多 LOCAL_TIMEOUT 秒后过期
+CACHE_ASIDE_MODELS = ('vul.Vul', 'vul.WhiteHat', 'headquarter.Alert')
+# 缓存命中统计在进程内累计, 每 CACHE_METRICS_INTERVAL 秒汇总到共享缓存, 见 /stats/cache
+CACHE_METRICS_INTERVAL = 10
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -143,6 +190,13 @@ EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_USE_SSL = True
 EMAIL_PORT = 465
 
+# 邮件队列: 失败后按 MAIL_QUEUE_RETRY_DELAY * 2^(n-1) 秒重试, 最多 MAIL_QUEUE_MAX_ATTEMPTS 次
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+MAIL_QUEUE_RETRY_DELAY = 60
+MAIL_QUEUE_MAX_DELAY = 6 * 3600
+# 每批邮件先在短事务中领取并租用 MAIL_QUEUE_LEASE 秒 (计一次尝试), 投递进程中途退出时租期过后重新投递
+MAIL_QUEUE_LEASE = 600
+
 # vul types
 
 VUL_TYPE_CHOICES = (
@@ -171,9 +225,41 @@ VUL_TYPE_CHOICES = (
     (16, '其他'),
 )
 
+# 全文索引: 为 True 时写入不再逐行更新 search_index, 由 manage.py update_search_index 批量重建
+SEARCH_INDEX_DEFERRED = False
+
+# agent 证书 DN 的进程内缓存, Agent 修改或删除后本进程立即失效, 其他进程在 default 缓存本地一层过期后 (LOCAL_TIMEOUT 秒内) 失效
+AGENT_CACHE_SIZE = 1024
+AGENT_CACHE_TTL = 300
+
+# 主机指纹按 ip:port 原地更新, 为 True 时被替换的旧指纹摘要写入 FingerprintHistory
+FINGERPRINT_HISTORY = True
+
+# 资产检索首页的分面统计由 manage.py refresh_facets 定期重算, 各进程缓存 FACETS_CACHE_TIMEOUT 秒
+FACETS_CACHE_TIMEOUT = 300
+
+# 资产检索结果 (主键列表) 的缓存时间, 有新数据写入时立即失效
+SEARCH_CACHE_TIMEOUT = 600
+
+# 产品目录 api/apps 的 since 增量查询回看 CATALOG_SINCE_OVERLAP 秒: first_seen 是写入事务开始的时间,
+# 事务提交前其他轮询已返回更晚的 latest, 回看时间须长于最长的采集事务, 重复返回的名称由 agent 去重
+CATALOG_SINCE_OVERLAP = 600
+
+# 预警关键词匹配的资产产品词典, 其他进程新写入的产品最多 MATCHER_REFRESH_INTERVAL 秒后加入
+MATCHER_REFRESH_INTERVAL = 300
+
+# 采集 API: 每个进程同时写库的批次数 INGEST_WORKERS, 另有最多 INGEST_QUEUE_SIZE 个请求排队 (边等待边读取请求体),
+# 队列满时返回 429, agent 在 INGEST_RETRY_AFTER 秒后重试; 请求体超过 INGEST_MAX_BODY 字节返回 413
+INGEST_WORKERS = 2
+INGEST_QUEUE_SIZE = 50
+INGEST_RETRY_AFTER = 5
+INGEST_MAX_BODY = 32 * 1024 * 1024
+
 CA_CERT = os.path.join(BASE_DIR, 'ca', 'ca.crt')
 CA_KEY = os.path.join(BASE_DIR, 'ca', 'ca.key')
 CA_KEY_PASSPHRASE = None
+# 后台预先生成的 agent 私钥数量, 0 为签发时再生成. 后台线程与未用的私钥常驻进程, 只在签发证书的进程中开启
+CERT_KEY_POOL_SIZE = int(os.environ.get('CERT_KEY_POOL_SIZE', 0))
 
 SITE_TITLE = '高校信息安全漏洞响应中心'  # 站点名称
 SITE_ORG = '江苏大学信息化中心'  # 运营机构
@@ -23,12 +23,12 @@ from django.views.generic import TemplateView
 import ujscert.vul.views as views
 
 urlpatterns = [
-    url(r'^$', TemplateView.as_view(template_name='index.html'), name='home'),
+    url(r'^$', views.static_page('index.html'), name='home'),
     url(r'^submit$', views.submit_view, name='submit'),
     url(r'^upload$', views.upload_img),
-    url(r'^about$', TemplateView.as_view(template_name='about.html'), name='about'),
+    url(r'^about$', views.static_page('about.html'), name='about'),
     url(r'^top10$', views.rank_view, name='rank'),
-    url(r'^legal$', TemplateView.as_view(template_name='legal.html'), name='legal'),
+    url(r'^legal$', views.static_page('legal.html'), name='legal'),
 
     url(r'^accounts/profile$', views.profile_view, name='profile'),
     url(r'^accounts/profile/edit$', views.update_profile_view, name='edit_profile'),
@@ -38,6 +38,10 @@ urlpatterns = [
     url(r'^profile/(?P<uid>\d+)$', views.profile_view, name='user_profile'),
     url(r'^detail/(?P<author>anonymous|member|all)/(?P<vid>\d+)$', views.detail_view, name='detail'),
     url(r'^comment/add/(?P<vid>\d+)', views.add_comment_view, name='add_comment'),
+    url(r'^comment/list/(?P<vid>\d+)$', views.comments_view, name='comments'),
+    url(r'^stats/pages$', views.render_stats_view, name='render_stats'),
+    url(r'^stats/cache$', views.cache_stats_view, name='cache_stats'),
+    url(r'^stats/db$', views.db_stats_view, name='db_stats'),
     url(r'^track/(?P<track_id>[0-9a-f]+)$', views.track_view, name='track'),
 
     url(r'^review/(?P<author>anonymous|member|all)/(?P<status>\d+|all)$', views.review_list_view, name='review'),
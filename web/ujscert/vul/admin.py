@@ -27,3 +27,9 @@ class CommentAdmin(admin.ModelAdmin):
             attrs={'rows': 8,
                    'cols': 40})},
     }
+
+
+@admin.register(OutboundMail)
+class OutboundMailAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'created', 'attempts', 'sent')
+    list_filter = ('sent',)
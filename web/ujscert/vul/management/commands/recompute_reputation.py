@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ujscert.vul.models import Vul, MemberVul, WhiteHat, invalidate_leaderboard
+
+SQL = '''
+UPDATE {whitehat} w SET reputation = s.reputation, reports = s.reports
+FROM (
+    SELECT w.id, COALESCE(SUM(v.score), 0) AS reputation, COUNT(m.vul_ptr_id) AS reports
+    FROM {whitehat} w
+    LEFT JOIN {membervul} m ON m.author_id = w.id
+    LEFT JOIN {vul} v ON v.id = m.vul_ptr_id
+    GROUP BY w.id
+) s
+WHERE w.id = s.id AND (w.reputation <> s.reputation OR w.reports <> s.reports)
+'''
+
+
+class Command(BaseCommand):
+    help = "Recompute every WhiteHat's reputation and report count in one grouped query, fixing drift."
+
+    def handle(self, *args, **options):
+        sql = SQL.format(whitehat=WhiteHat._meta.db_table, membervul=MemberVul._meta.db_table,
+                         vul=Vul._meta.db_table)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql)
+            if cursor.rowcount:
+                invalidate_leaderboard()
+            self.stdout.write('%d white hats corrected' % cursor.rowcount)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ujscert.vul.utils import deliver_queued_mail
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbound mail over a single SMTP connection per batch, with retry and backoff.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='messages per SMTP connection')
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument('--interval', type=float, default=5, help='seconds to sleep when idle in --loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = deliver_queued_mail(options['limit'])
+            if sent or failed:
+                self.stdout.write('%d sent, %d failed' % (sent, failed))
+
+            if not options['loop']:
+                break
+
+            if sent + failed < options['limit']:
+                time.sleep(options['interval'])
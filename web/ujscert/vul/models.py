@@ -9,12 +9,16 @@ from datetime import datetime
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
+from django.core.cache import cache
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models import Sum
-from django.db.models.signals import post_delete, post_save
+from django.db.models import F, Sum
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
 from django.forms import forms
+from django.utils import timezone
+
+from ujscert.cache import invalidate, invalidate_models
 
 STATUS_UNVERIFIED = 0
 STATUS_CONFIRMED = 1
@@ -70,10 +74,28 @@ class Vul(models.Model):
         return self.title
 
 
+VUL_VERSION_KEY = 'vul:version:%s'  # per uuid, what the public track page of a report shows
+
+
+def profile_cache_key(user_id):
+    return 'whitehat:user:%d' % user_id
+
+
+def invalidate_leaderboard():
+    invalidate_models(WhiteHat)  # the leaderboard is a cache_aside of WhiteHat, see vul.utils
+
+
+def invalidate_profile(user_id):
+    invalidate(lambda: cache.delete(profile_cache_key(user_id)))
+
+
 @receiver(post_save, sender=User)
 def add_white_hat(sender, instance, **kwargs):
     if kwargs.get('created'):
         WhiteHat(user=instance).save()
+    elif kwargs.get('update_fields') != frozenset(['last_login']):  # username or email may have changed
+        invalidate_profile(instance.pk)
+        invalidate_leaderboard()
 
 
 @receiver(post_delete, sender=Vul)
@@ -100,6 +122,18 @@ class WhiteHat(models.Model):
         return self.user.username
 
 
+@receiver(post_delete, sender=WhiteHat)
+@receiver(post_save, sender=WhiteHat)
+def white_hat_changed(sender, instance, **kwargs):
+    invalidate_profile(instance.user_id)
+
+
+def reputation_changed(whitehat_id):
+    for user_id in WhiteHat.objects.filter(pk=whitehat_id).values_list('user_id', flat=True):
+        invalidate_profile(user_id)
+    invalidate_leaderboard()
+
+
 class AnonymousVul(Vul):
     ip = models.GenericIPAddressField()
     email = models.EmailField(blank=True, null=True)
@@ -112,14 +146,61 @@ class MemberVul(Vul):
     anonymous = False
 
 
+def adjust_reputation(whitehat_id, score, reports):
+    if whitehat_id is not None and (score or reports):
+        WhiteHat.objects.filter(pk=whitehat_id).update(
+            reputation=F('reputation') + score, reports=F('reports') + reports)
+        reputation_changed(whitehat_id)
+
+
+def recount_reputation(whitehat_id):
+    vuls = MemberVul.objects.filter(author_id=whitehat_id)
+    WhiteHat.objects.filter(pk=whitehat_id).update(
+        reputation=vuls.aggregate(Sum('score')).get('score__sum') or 0, reports=vuls.count())
+    reputation_changed(whitehat_id)
+
+
+@receiver(post_init, sender=MemberVul)
+def remember_score(sender, instance, **kwargs):
+    # (author, score) as last counted into the author's reputation
+    instance._counted = (instance.__dict__.get('author_id'), instance.__dict__.get('score'))
+
+
+@receiver(post_save, sender=MemberVul)
+def update_score(sender, instance, created, **kwargs):
+    author, score = instance.author_id, instance.score or 0
+    counted_author, counted_score = instance._counted
+
+    if created:
+        adjust_reputation(author, score, 1)
+    elif counted_author is None or counted_score is None:  # deferred fields, nothing to diff against
+        recount_reputation(author)
+    elif counted_author != author:
+        adjust_reputation(counted_author, -counted_score, -1)
+        adjust_reputation(author, score, 1)
+    else:
+        adjust_reputation(author, score - counted_score, 0)
+
+    instance._counted = (author, score)
+
+
 @receiver(post_delete, sender=MemberVul)
+def remove_score(sender, instance, **kwargs):
+    author, score = instance._counted
+    if author is None or score is None:
+        recount_reputation(instance.author_id)
+    else:
+        adjust_reputation(author, -score, -1)
+
+
+@receiver(post_delete, sender=AnonymousVul)
+@receiver(post_delete, sender=MemberVul)
+@receiver(post_delete, sender=Vul)
+@receiver(post_save, sender=AnonymousVul)
 @receiver(post_save, sender=MemberVul)
-def update_score(sender, instance, **kwargs):
-    whitehat = WhiteHat.objects.get(pk=instance.author_id)
-    vuls = MemberVul.objects.filter(author=whitehat)
-    whitehat.reputation = vuls.aggregate(Sum('score')).get('score__sum')
-    whitehat.reports = vuls.count()
-    whitehat.save()
+@receiver(post_save, sender=Vul)
+def vul_changed(sender, instance, **kwargs):
+    invalidate(lambda: cache.delete(VUL_VERSION_KEY % instance.uuid.hex))
 
 
 def image_name(instance, filename):
@@ -168,6 +249,25 @@ class Invitation(models.Model):
         return '%s - %s' % (self.code, self.email)
 
 
+class OutboundMail(models.Model):
+    """待发送邮件, 由 manage.py send_queued_mail 投递"""
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=256)
+    body = models.TextField()
+    html = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    scheduled = models.DateTimeField(default=timezone.now)  # 下次尝试投递的时间
+    attempts = models.IntegerField(default=0)
+    sent = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)  # 最近一次失败原因
+
+    class Meta:
+        index_together = [('sent', 'scheduled')]
+
+    def __str__(self):
+        return '%s: %s' % (self.recipient, self.subject)
+
+
 class Timeline(models.Model):
     """事件"""
     vul = models.ForeignKey(Vul)
@@ -1,3 +1,373 @@
-from django.test import TestCase
+import threading
+import uuid
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.core.signals import request_started
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ujscert.cache import metrics, model_versions, METRICS_KEY
+from ujscert.db import stats
+from ujscert.vul.models import Vul, OutboundMail, MemberVul, WhiteHat, Comment, Timeline, STATUS_CONFIRMED, \
+    VUL_VERSION_KEY
+from ujscert.vul.views import COMMENT_PAGE_SIZE
+from ujscert.vul.utils import send_rendered_mail, deliver_queued_mail, leaderboard, to_review, render_stats, \
+    pending_review_count
+
+
+class MailQueueTestCase(TestCase):
+    def test_queue_and_deliver(self):
+        queued = send_rendered_mail(['a@ujs.edu.cn', 'b@ujs.edu.cn'], 'submission_alert',
+                                    {'review_url': 'http://localhost/detail/member/1'})
+        self.assertEqual(queued, 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(deliver_queued_mail(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('http://localhost/detail/member/1', mail.outbox[0].alternatives[0][0])
+        self.assertFalse(OutboundMail.objects.filter(sent__isnull=True).exists())
+        self.assertEqual(deliver_queued_mail(), (0, 0))
+
+    def test_retry_with_backoff(self):
+        send_rendered_mail('a@ujs.edu.cn', 'ignored', {'vul': {'title': 'xss'}})
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.assertEqual(deliver_queued_mail(), (0, 1))
+
+        queued = OutboundMail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertEqual(queued.error, 'down')
+        self.assertGreater(queued.scheduled, queued.created)
+
+        # not due yet
+        self.assertEqual(deliver_queued_mail(), (0, 0))
+        OutboundMail.objects.update(scheduled=queued.created)
+        self.assertEqual(deliver_queued_mail(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_claim(self):
+        send_rendered_mail(['a@ujs.edu.cn', 'b@ujs.edu.cn'], 'ignored', {'vul': {'title': 'xss'}})
+        sends = []
+
+        def send(messages):
+            sends.append(messages)
+            if len(sends) == 2:
+                raise SystemExit  # the worker dies mid-batch
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send):
+            self.assertRaises(SystemExit, deliver_queued_mail)
+        self.assertEqual(OutboundMail.objects.filter(sent__isnull=False).count(), 1)
+
+        self.assertEqual(deliver_queued_mail(), (0, 0))  # leased
+        OutboundMail.objects.update(scheduled=timezone.now())
+        self.assertEqual(deliver_queued_mail(), (1, 0))
+        self.assertEqual(OutboundMail.objects.get(recipient='b@ujs.edu.cn').attempts, 2)
+
+
+class ReputationTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice').whitehat
+        self.bob = User.objects.create_user('bob').whitehat
+
+    def reputation(self, whitehat):
+        whitehat.refresh_from_db()
+        return whitehat.reputation, whitehat.reports
+
+    def report(self, score):
+        return MemberVul.objects.create(title='xss', category=6, detail='...', author=self.alice, score=score)
+
+    def test_incremental(self):
+        vul = self.report(3)
+        self.report(4)
+        self.assertEqual(self.reputation(self.alice), (7, 2))
+
+        vul = MemberVul.objects.get(pk=vul.pk)
+        vul.status = STATUS_CONFIRMED
+        with self.assertNumQueries(2):  # vul_vul and vul_membervul, no WhiteHat query
+            vul.save()
+
+        vul.score = 5
+        vul.save()
+        self.assertEqual(self.reputation(self.alice), (9, 2))
+
+        vul.author = self.bob
+        vul.save()
+        self.assertEqual(self.reputation(self.alice), (4, 1))
+        self.assertEqual(self.reputation(self.bob), (5, 1))
+
+        MemberVul.objects.get(pk=vul.pk).delete()
+        self.assertEqual(self.reputation(self.bob), (0, 0))
+
+    def test_recompute(self):
+        self.report(3)
+        WhiteHat.objects.update(reputation=100, reports=100)
+
+        call_command('recompute_reputation', stdout=StringIO())
+        self.assertEqual(self.reputation(self.alice), (3, 1))
+        self.assertEqual(self.reputation(self.bob), (0, 0))
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i, department in enumerate(['cs', 'cs', 'math']):
+            whitehat = User.objects.create_user('user%d' % i).whitehat
+            whitehat.department = department
+            whitehat.public = True
+            whitehat.save()
+            MemberVul.objects.create(title='xss', category=6, detail='...', author=whitehat, score=i + 1)
+
+    def usernames(self, rows):
+        return [row['username'] for row in rows]
+
+    def test_cached(self):
+        self.assertEqual(self.usernames(leaderboard(2)), ['user2', 'user1'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.usernames(leaderboard(3)), ['user2', 'user1', 'user0'])
+
+        self.assertEqual(self.usernames(leaderboard(10, 'cs')), ['user1', 'user0'])
+
+        user0 = WhiteHat.objects.get(user__username='user0')
+        MemberVul.objects.create(title='rce', category=7, detail='...', author=user0, score=10)
+        self.assertEqual(self.usernames(leaderboard(1)), ['user0'])
+
+    @mock.patch('ujscert.vul.utils.LEADERBOARD_SIZE', 2)
+    def test_beyond_cached(self):
+        self.assertEqual(self.usernames(leaderboard(2)), ['user2', 'user1'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.usernames(leaderboard(3)), ['user2', 'user1', 'user0'])
+
+    def test_rank_view(self):
+        with self.assertNumQueries(1):
+            self.client.get('/top10')
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/top10', {'n': 1})
+
+        self.assertContains(response, 'user2')
+        self.assertNotContains(response, 'user1')
+
+
+class ToReviewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user('staff', 'staff@example.com', is_staff=True)
+        self.request = mock.Mock(user=self.staff)
+
+    def test_lazy(self):
+        with self.assertNumQueries(0):
+            context = to_review(self.request)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(context['self_profile'].user.username, 'staff')
+            self.assertEqual(str(context['to_be_review']), '0')
+
+        with self.assertNumQueries(0):
+            context = to_review(self.request)
+            self.assertEqual(context['self_profile'].pk, self.staff.whitehat.pk)
+            self.assertFalse(context['to_be_review'])
+
+    def test_invalidate(self):
+        self.assertFalse(to_review(self.request)['to_be_review'])
+        MemberVul.objects.create(title='xss', category=6, detail='...', author=self.staff.whitehat)
+        self.assertEqual(str(to_review(self.request)['to_be_review']), '1')
+
+        self.staff.email = 'new@example.com'
+        self.staff.save()
+        self.assertEqual(to_review(self.request)['self_profile'].user.email, 'new@example.com')
+
+    def test_anonymous(self):
+        request = mock.Mock(user=mock.Mock(is_staff=False, is_authenticated=lambda: False))
+        with self.assertNumQueries(0):
+            context = to_review(request)
+            self.assertFalse(context['self_profile'])
+            self.assertFalse(context['to_be_review'])
+
+
+class DetailTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'alice')
+        self.staff = User.objects.create_user('staff', 'staff@example.com', 'staff', is_staff=True)
+        self.vul = MemberVul.objects.create(title='xss', category=6, detail='...', author=self.alice.whitehat)
+        Timeline.objects.create(vul=self.vul, extra={'status': STATUS_CONFIRMED})
+
+    def comment(self, count):
+        for i in range(count):
+            author = User.objects.create_user('user%d_%d' % (Comment.objects.count(), i)).whitehat
+            Comment.objects.create(vul=self.vul, author=author, content='comment %d' % i)
+
+    def queries(self, user):
+        cache.clear()  # to_review caches the navigation bar counters after the first page
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/detail/member/%d' % self.vul.pk)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        for user in (self.staff, self.alice):
+            self.comment(2)
+            few = self.queries(user)
+            self.comment(20)
+            self.assertEqual(self.queries(user), few)
+
+    def test_comments_since(self):
+        self.comment(COMMENT_PAGE_SIZE + 5)
+        self.client.force_login(self.alice)
+        response = self.client.get('/detail/member/%d' % self.vul.pk)
+        self.assertEqual(len(response.context['comments']), COMMENT_PAGE_SIZE)
+        self.assertTrue(response.context['more_comments'])
+
+        page = self.client.get('/comment/list/%d' % self.vul.pk, {'since': response.context['comments_since']}).json()
+        self.assertEqual([comment['content'] for comment in page['comments']],
+                         ['comment %d' % i for i in range(COMMENT_PAGE_SIZE, COMMENT_PAGE_SIZE + 5)])
+        self.assertFalse(page['more'])
+        last = self.client.get('/comment/list/%d' % self.vul.pk, {'since': page['since']})
+        self.assertEqual(last.json()['comments'], [])
+
+        self.client.force_login(User.objects.create_user('mallory'))
+        self.assertEqual(self.client.get('/comment/list/%d' % self.vul.pk).status_code, 404)
+        self.assertEqual(self.client.get('/detail/member/%d' % self.vul.pk).status_code, 404)
+
+
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        metrics.flush()  # counts of earlier tests
+        cache.clear()
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'alice')
+        self.vul = MemberVul.objects.create(title='xss', category=6, detail='...', author=self.alice.whitehat)
+        self.url = '/track/%s' % self.vul.uuid.hex
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, '待审核')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        self.vul.status = STATUS_CONFIRMED
+        self.vul.save()
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(changed, '已确认')
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(self.client.get('/track/%s' % ('0' * 32)).status_code, 404)
+
+        for url in ('/top10', '/about'):
+            etag = self.client.get(url)['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.assertIsNone(cache.get(METRICS_KEY % ('render:track', 'requests')))  # summed in the process until due
+        stats = render_stats()['track']
+        self.assertEqual((stats['requests'], stats['not_modified'], stats['misses']), (4, 1, 2))
+
+    def test_version_race(self):
+        other = MemberVul.objects.create(title='csrf', category=6, detail='...', author=self.alice.whitehat)
+        add = cache.add
+
+        def racing_add(key, *args, **kwargs):
+            caches['shared'].add(key, uuid.uuid4().hex, None)  # another worker, between our get and our add
+            return add(key, *args, **kwargs)
+
+        etags = []
+        for vul in (self.vul, other):
+            cache.delete(VUL_VERSION_KEY % vul.uuid.hex)
+            with mock.patch.object(cache, 'add', racing_add):
+                response = self.client.get('/track/%s' % vul.uuid.hex)
+            self.assertContains(response, vul.title)
+            etags.append(response['ETag'])
+        self.assertNotEqual(etags[0], etags[1])
+
+    def test_fragments(self):
+        self.client.force_login(self.alice)
+        self.assertNotIn('ETag', self.client.get(self.url))  # pages of signed-in users show their name
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(self.url), 'xss')
+        self.assertFalse([q for q in queries.captured_queries if 'FROM "vul_vul"' in q['sql']])
+        self.assertEqual(render_stats()['track']['hits'], 1)
+
+        staff = User.objects.create_user('staff', 'staff@example.com', 'staff', is_staff=True)
+        self.client.force_login(staff)
+        self.assertIn('track', self.client.get('/stats/pages').json())
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        metrics.flush()  # counts of earlier tests
+        cache.clear()
+
+    def test_tiered(self):
+        profile = {'name': 'alice'}
+        cache.set('profile', profile)
+        copy = cache.get('profile')
+        copy['name'] = 'mallory'
+        self.assertEqual(cache.get('profile'), profile)
+
+        caches['shared'].set('profile', {'name': 'bob'})  # written by another process
+        self.assertEqual(cache.get('profile'), profile)
+        cache.local.clear()  # LOCAL_TIMEOUT later
+        self.assertEqual(cache.get('profile'), {'name': 'bob'})
+
+        cache.delete('profile')
+        self.assertIsNone(caches['shared'].get('profile'))
+
+    def test_tiered_threads(self):
+        cache.set('profile', {'name': 'alice'})
+        caches['shared'].delete('profile')  # only the local copy is left
+        found = []
+        thread = threading.Thread(target=lambda: found.append(cache.get('profile')))  # its own backend instance
+        thread.start()
+        thread.join()
+        self.assertEqual(found, [{'name': 'alice'}])
+
+    def test_version_race(self):
+        add = cache.add
+
+        def racing_add(key, *args, **kwargs):
+            caches['shared'].add(key, 'theirs', None)  # another worker, between our get and our add
+            return add(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'add', racing_add):
+            self.assertEqual(model_versions(Vul), ['theirs'])
+
+    def test_cache_aside(self):
+        alice = User.objects.create_user('alice', 'alice@example.com', 'alice')
+        MemberVul.objects.create(title='xss', category=6, detail='...', author=alice.whitehat)
+        self.assertEqual(pending_review_count(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(pending_review_count(), 1)
+
+        vul = Vul.objects.only('status').get()  # a deferred class, a subclass of Vul
+        vul.status = STATUS_CONFIRMED
+        vul.save(update_fields=['status'])
+        self.assertEqual(pending_review_count(), 0)
+
+        staff = User.objects.create_user('staff', 'staff@example.com', 'staff', is_staff=True)
+        self.client.force_login(staff)
+        report = self.client.get('/stats/cache').json()
+        self.assertEqual(report['ujscert.vul.utils.pending_review_count']['misses'], 2)
+        self.assertGreater(report['tiered']['local_hits'], 0)
+
+
+class ConnectionTestCase(TransactionTestCase):
+    @override_settings(DB_HEALTH_CHECK_INTERVAL=0)
+    def test_health_check(self):
+        connection.ensure_connection()
+        connection.close_at = None  # kept across requests, as with CONN_MAX_AGE
+        connects, unusable = stats['default', 'connects'], stats['default', 'unusable']
+        with mock.patch.object(connection, 'is_usable', return_value=False):  # e.g. pgbouncer restarted
+            request_started.send(sender=self.__class__)
+        self.assertIsNone(connection.connection)
+        self.assertEqual(stats['default', 'unusable'], unusable + 1)
+
+        staff = User.objects.create_user('staff', 'staff@example.com', 'staff', is_staff=True)
+        self.client.force_login(staff)
+        report = self.client.get('/stats/db').json()
+        self.assertGreater(report['default']['connects'], connects)
+        self.assertGreater(sum(report['backends'].values()), 0)
@@ -1,24 +1,104 @@
 # coding=utf-8
+import hashlib
+import time
+import uuid
+from datetime import timedelta
+from functools import lru_cache
 from os import path
 
 from django.conf import settings
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.template.loader import render_to_string, get_template
+from django.template.response import SimpleTemplateResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import available_attrs
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import quote_etag
+from django.utils.six import wraps
 
-from ujscert.vul.models import Vul, WhiteHat
+from ujscert.cache import cache_aside, metrics, model_versions, stored_version
+from ujscert.vul.models import Vul, WhiteHat, OutboundMail, VUL_VERSION_KEY, profile_cache_key
+
+LEADERBOARD_SIZE = 100  # rows materialized per department, a larger N is queried uncached
+LEADERBOARD_TIMEOUT = 3600
+PROFILE_TIMEOUT = 3600
+PENDING_REVIEW_TIMEOUT = 300  # upper bound on staleness should an invalidation be missed
+FRAGMENT_TIMEOUT = 3600  # rendered fragments are keyed on data versions, this only bounds their lifetime
+
+CACHED_PAGES = set()  # names passed to cached_page, reported by render_stats
+RENDER_STATS = ('requests', 'not_modified', 'renders', 'render_us', 'misses', 'miss_us')
+
+
+def cached_profile(user_id):
+    """the user's WhiteHat with its user joined, cached until the profile, user or reputation changes"""
+    key = profile_cache_key(user_id)
+    profile = cache.get(key)
+    if profile is None:
+        profile = WhiteHat.objects.select_related('user').get(user_id=user_id)
+        cache.set(key, profile, PROFILE_TIMEOUT)
+    return profile
+
+
+@cache_aside(Vul, timeout=PENDING_REVIEW_TIMEOUT)
+def pending_review_count():
+    """number of reports waiting for review, cached until a report is saved or deleted"""
+    return Vul.objects.filter(status=0).count()
 
 
 def to_review(request):
-    context = {}
-    if request.user.is_authenticated():
-        context.update({'self_profile': WhiteHat.objects.get(user=request.user)})
+    """
+    Both values are lazy: pages that never render them cost nothing, and the ones that do
+    are usually served from the cache.
+    """
+    def profile():
+        if request.user.is_authenticated():
+            return cached_profile(request.user.pk)
+
+    def pending():
+        if request.user.is_staff:
+            return pending_review_count()
+
+    return {
+        'self_profile': SimpleLazyObject(profile),
+        'to_be_review': SimpleLazyObject(pending),
+    }
+
+
+def leaderboard_query(limit, department):
+    qs = WhiteHat.objects.filter(public=True).select_related('user').order_by('-reputation', 'pk')
+    if department:
+        qs = qs.filter(department=department)
+
+    return [{
+        'id': whitehat.pk,
+        'username': whitehat.user.username,
+        'department': whitehat.department,
+        'reputation': whitehat.reputation,
+        'reports': whitehat.reports,
+        'avatar': whitehat.avatar,
+    } for whitehat in qs[:limit]]
 
-    if request.user.is_staff:
-        context.update({
-            'to_be_review': Vul.objects.filter(status=0).count(),
-        })
 
-    return context
+@cache_aside(WhiteHat, timeout=LEADERBOARD_TIMEOUT)
+def leaderboard_rows(department):
+    return leaderboard_query(LEADERBOARD_SIZE, department)
+
+
+def leaderboard(limit=10, department=None):
+    """
+    Top `limit` public white hats, optionally within one department, as plain dicts.
+    The top LEADERBOARD_SIZE rows are materialized in the cache with one query and reused until a white hat
+    changes (see invalidate_leaderboard), so a hit costs no query at all. A larger `limit` is served by an
+    uncached query.
+    """
+    if limit > LEADERBOARD_SIZE:
+        return leaderboard_query(limit, department)
+    return leaderboard_rows(department)[:limit]
 
 
 def customize(request):
@@ -38,11 +118,17 @@ def get_client_ip(request):
     return ip
 
 
-# todo: async
-def send_rendered_mail(address, template_name='invite', args=None):
+def send_rendered_mail(recipients, template_name='invite', args=None):
+    """
+    Render a mail template and queue it for each recipient, returns the number of queued messages.
+    Nothing is sent here, `manage.py send_queued_mail` delivers the queue.
+    """
     if args is None:
         args = {}
 
+    if isinstance(recipients, str):
+        recipients = [recipients]
+
     site_title = getattr(settings, 'SITE_TITLE')
     templates = {
         'invite': '注册邀请',
@@ -50,17 +136,194 @@ def send_rendered_mail(address, template_name='invite', args=None):
         'submission_alert': '新的漏洞报告',
     }
 
-    if template_name in templates:
+    if template_name in templates and recipients:
         subject = '[%s] %s' % (site_title, templates[template_name])
         msg_plain = render_to_string(path.join('mail', '%s.txt' % template_name), args)
         msg_html = render_to_string(path.join('mail', '%s.html' % template_name), args)
 
-        return send_mail(
-            subject,
-            msg_plain,
-            settings.EMAIL_SENDER,
-            [address],
-            html_message=msg_html,
-            fail_silently=True)
+        queued = OutboundMail.objects.bulk_create(
+            OutboundMail(recipient=address, subject=subject, body=msg_plain, html=msg_html)
+            for address in recipients)
+        return len(queued)
 
     return 0
+
+
+def retry_delay(attempts):
+    """exponential backoff, capped at MAIL_QUEUE_MAX_DELAY"""
+    delay = getattr(settings, 'MAIL_QUEUE_RETRY_DELAY', 60) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, getattr(settings, 'MAIL_QUEUE_MAX_DELAY', 6 * 3600)))
+
+
+def deliver_queued_mail(limit=100):
+    """
+    Send up to `limit` due messages over a single SMTP connection.
+    The batch is claimed in a short transaction first: each message counts an attempt and is leased for
+    MAIL_QUEUE_LEASE seconds, so other workers skip it and the messages of a worker that died come due again.
+    Each result is saved as soon as it is known, outside any transaction.
+    Failed messages are rescheduled with backoff until MAIL_QUEUE_MAX_ATTEMPTS is reached.
+    Returns (sent, failed).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(OutboundMail.objects.select_for_update().filter(
+            sent__isnull=True, scheduled__lte=now,
+            attempts__lt=getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', 5),
+        ).order_by('scheduled', 'pk')[:limit])
+        if not batch:
+            return 0, 0
+
+        lease = now + timedelta(seconds=getattr(settings, 'MAIL_QUEUE_LEASE', 600))
+        OutboundMail.objects.filter(pk__in=[mail.pk for mail in batch]).update(
+            attempts=F('attempts') + 1, scheduled=lease)
+
+    def retry(mail, e):
+        mail.error = str(e) or e.__class__.__name__
+        mail.scheduled = timezone.now() + retry_delay(mail.attempts)
+        mail.save(update_fields=['error', 'scheduled'])
+
+    for mail in batch:
+        mail.attempts += 1
+
+    sent = failed = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+        for mail in batch:
+            message = EmailMultiAlternatives(mail.subject, mail.body, settings.EMAIL_SENDER, [mail.recipient],
+                                             connection=connection)
+            if mail.html:
+                message.attach_alternative(mail.html, 'text/html')
+
+            try:
+                message.send()
+            except Exception as e:
+                retry(mail, e)
+                failed += 1
+            else:
+                mail.sent = timezone.now()
+                mail.save(update_fields=['sent'])
+                sent += 1
+
+    except Exception as e:  # could not connect, retry the rest of the batch later
+        for mail in batch[sent + failed:]:
+            retry(mail, e)
+            failed += 1
+
+    finally:
+        connection.close()
+
+    return sent, failed
+
+
+def count(page, stat, n=1):
+    """add `n` to a render counter, summed in the process and flushed to the cache with the other metrics"""
+    metrics.add('render:%s' % page, stat, n)
+
+
+def render_stats():
+    """
+    Per cached page: requests, 304s, hits (renders from cached fragments) and misses, and the render time
+    they saved, estimated from the average time of a miss and of a full render.
+    """
+    totals = metrics.totals({'render:%s' % page: RENDER_STATS for page in CACHED_PAGES})
+    stats = {}
+    for page in sorted(CACHED_PAGES):
+        requests, not_modified, renders, render_us, misses, miss_us = (
+            totals['render:%s' % page][stat] for stat in RENDER_STATS)
+        hits = renders - misses
+        hit_ms = (render_us - miss_us) / hits / 1000 if hits else 0
+        miss_ms = miss_us / misses / 1000 if misses else 0
+        stats[page] = {
+            'requests': requests,
+            'not_modified': not_modified,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': (hits + not_modified) / requests if requests else 0,
+            'render_ms': render_us / renders / 1000 if renders else 0,
+            'saved_ms': round(hits * max(miss_ms - hit_ms, 0) + not_modified * (miss_ms or hit_ms)),
+        }
+    return stats
+
+
+def page_data(request, func):
+    """
+    func(), loaded lazily for a cached_page: templates only touch it when a fragment has to be rendered,
+    which counts the request as a miss.
+    """
+    def load():
+        request.fragment_miss = True
+        return func()
+
+    return SimpleLazyObject(load)
+
+
+def cached_page(page, version):
+    """
+    Conditional GET for a public page. version(request, *args, **kwargs) names the data the page shows and
+    changes with it, it should be answered from the cache. Anonymous visitors get an ETag derived from it and
+    a 304 without rendering when they revalidate; signed-in users see their own navigation bar, so their
+    pages are rendered every time, from cached fragments (see page_data).
+    """
+    CACHED_PAGES.add(page)
+
+    def decorator(view):
+        @wraps(view, assigned=available_attrs(view))
+        def wrapper(request, *args, **kwargs):
+            count(page, 'requests')
+            etag = None
+            if not request.user.is_authenticated():
+                data = '%s:%s' % (page, version(request, *args, **kwargs))
+                etag = hashlib.md5(data.encode('utf8')).hexdigest()
+                response = get_conditional_response(request, etag=etag)
+                if response is not None:
+                    count(page, 'not_modified')
+                    response['ETag'] = quote_etag(etag)
+                    return response
+
+            start = time.time()
+            response = view(request, *args, **kwargs)
+            if isinstance(response, SimpleTemplateResponse):
+                response.render()
+            elapsed = int((time.time() - start) * 1000000)
+            count(page, 'renders')
+            count(page, 'render_us', elapsed)
+            if getattr(request, 'fragment_miss', False):
+                count(page, 'misses')
+                count(page, 'miss_us', elapsed)
+
+            if etag is not None and response.status_code == 200:
+                response['ETag'] = quote_etag(etag)
+                patch_cache_control(response, no_cache=True)  # revalidate on every visit, a 304 is cheap
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def vul_version(request, track_id):
+    """version of the report a track page shows, Http404 for an unknown id"""
+    try:
+        track_id = uuid.UUID(track_id).hex
+    except ValueError:
+        raise Http404
+
+    key = VUL_VERSION_KEY % track_id
+    version = cache.get(key)
+    if version is None:
+        if not Vul.objects.filter(uuid=track_id).exists():
+            raise Http404
+        version = stored_version(key)
+    return version
+
+
+def leaderboard_version(request):
+    return '%s:%s' % (model_versions(WhiteHat)[0], request.GET.urlencode())
+
+
+@lru_cache()
+def template_version(template_name):
+    """static pages change only with a deployment: the modification time of their templates"""
+    return '%s:%s' % (path.getmtime(get_template(template_name).origin.name),
+                      path.getmtime(get_template('base.html').origin.name))
@@ -6,9 +6,9 @@ from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.urlresolvers import reverse
 from django.db import transaction
+from django.db.models import Prefetch
 from django.http import JsonResponse, HttpResponseBadRequest
 from django.shortcuts import render, redirect, get_object_or_404, render_to_response
 from django.template import RequestContext
@@ -16,14 +16,20 @@ from django.template.loader import render_to_string
 from django.utils.datetime_safe import datetime
 from django.utils.http import is_safe_url, urlencode
 from django.views.decorators.http import require_http_methods, require_POST, require_GET
+from django.views.generic import TemplateView
 
-from ujscert.headquarter.utils import staff_required
+from ujscert.cache import metrics
+from ujscert.db import connection_stats, server_connections
+from ujscert.headquarter.utils import staff_required, CursorPaginator
 from ujscert.vul.forms import AnonymousReportForm, ReportForm, ImageUploadForm, LoginForm, ProfileForm, ReviewForm, \
     CommentForm
 from ujscert.vul.models import Vul, MemberVul, WhiteHat, AnonymousVul, Invitation, \
     STATUS_CHOICES, STATUS_UNVERIFIED, STATUS_CONFIRMED, STATUS_FIXED, STATUS_IGNORED, \
     STATUS_TO_REVIEW, Comment, Timeline, TIMELINE_CHANGE_STATUS
-from ujscert.vul.utils import send_rendered_mail, get_client_ip
+from ujscert.vul.utils import send_rendered_mail, get_client_ip, leaderboard, cached_page, page_data, vul_version, \
+    leaderboard_version, template_version, render_stats, FRAGMENT_TIMEOUT
+
+COMMENT_PAGE_SIZE = 50  # comments rendered with a vul, the rest are loaded through comments_view
 
 
 @transaction.atomic()
@@ -60,13 +66,10 @@ def submit_view(request):
             }
 
             # 发送邮件至管理员
-            try:
-                for user in User.objects.filter(is_staff=True, email__isnull=False):
-                    send_rendered_mail(user.email, 'submission_alert', {
-                        'review_url': request.build_absolute_uri(reverse('detail', kwargs=redirect_args))
-                    })
-            except:
-                pass
+            staff = User.objects.filter(is_staff=True, email__isnull=False).exclude(email='')
+            send_rendered_mail(list(staff.values_list('email', flat=True)), 'submission_alert', {
+                'review_url': request.build_absolute_uri(reverse('detail', kwargs=redirect_args))
+            })
 
             if not dest:
                 dest = redirect('detail', **redirect_args)
@@ -104,10 +107,39 @@ def login_view(request):
     return render(request, 'login.html', data)
 
 
+def static_page(template_name):
+    """TemplateView of a page without data, anonymous visitors revalidate it with a 304"""
+    return cached_page(template_name.split('.')[0], lambda request: template_version(template_name))(
+        TemplateView.as_view(template_name=template_name))
+
+
 @require_GET
+@cached_page('track', vul_version)
 def track_view(request, track_id):
-    vul = get_object_or_404(Vul, uuid=track_id)
-    return render(request, 'track.html', {'vul': vul})
+    return render(request, 'track.html', {
+        'vul': page_data(request, lambda: get_object_or_404(Vul, uuid=track_id)),
+        'version': vul_version(request, track_id),
+        'fragment_timeout': FRAGMENT_TIMEOUT,
+    })
+
+
+@require_GET
+@staff_required
+def render_stats_view(request):
+    return JsonResponse(render_stats())
+
+
+@require_GET
+@staff_required
+def cache_stats_view(request):
+    return JsonResponse(metrics.report())
+
+
+@require_GET
+@staff_required
+def db_stats_view(request):
+    """connection metrics of the worker answering, and the backends the database server runs"""
+    return JsonResponse(dict(connection_stats(), backends=server_connections()))
 
 
 @require_POST
@@ -165,6 +197,45 @@ def update_profile_view(request):
         context_instance=RequestContext(request))
 
 
+def readable_vuls(request, model):
+    """vuls of `model` the user may open: any for staff, a member only sees their own reports"""
+    if request.user.is_staff or request.user.is_superuser:
+        return model.objects.all()
+    return MemberVul.objects.filter(author__user=request.user)
+
+
+def comment_page(vid, since=0):
+    """up to COMMENT_PAGE_SIZE comments of a vul posted after comment `since`, oldest first, and whether more follow"""
+    comments = list(Comment.objects.filter(vul_id=vid, pk__gt=since).select_related('author__user')
+                    .order_by('pk')[:COMMENT_PAGE_SIZE + 1])
+    return comments[:COMMENT_PAGE_SIZE], len(comments) > COMMENT_PAGE_SIZE
+
+
+@require_GET
+@login_required
+def comments_view(request, vid):
+    """comments after the `since` comment id, for loading long threads (and new replies) incrementally"""
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    get_object_or_404(readable_vuls(request, Vul).values('pk'), pk=vid)
+    comments, more = comment_page(vid, since)
+    return JsonResponse({
+        'comments': [{
+            'id': comment.pk,
+            'author': comment.author.user.username,
+            'profile': reverse('user_profile', kwargs={'uid': comment.author_id}),
+            'avatar': comment.author.avatar,
+            'timestamp': comment.timestamp,
+            'content': comment.content,
+        } for comment in comments],
+        'since': comments[-1].pk if comments else since,
+        'more': more,
+    })
+
+
 @require_POST
 @transaction.atomic()
 @login_required
@@ -193,9 +264,13 @@ def add_comment_view(request, vid):
 def detail_view(request, author, vid):
     is_anonymous = author == 'anonymous'
     model = AnonymousVul if is_anonymous else MemberVul
+    vuls = readable_vuls(request, model).prefetch_related(
+        Prefetch('timeline_set', queryset=Timeline.objects.order_by('timestamp'), to_attr='events'))
+    if vuls.model is MemberVul:
+        vuls = vuls.select_related('author__user')
 
     if request.user.is_staff or request.user.is_superuser:
-        vul = get_object_or_404(model, pk=vid)
+        vul = get_object_or_404(vuls, pk=vid)
         status_before = vul.status
 
         if request.method == 'GET':
@@ -239,12 +314,10 @@ def detail_view(request, author, vid):
 
     else:
         # only show vul report by user itself
-        whitehat = WhiteHat.objects.get(user=request.user)
-        vul = get_object_or_404(MemberVul, author=whitehat, pk=vid)
+        vul = get_object_or_404(vuls, pk=vid)
         form = None
 
-    events = Timeline.objects.filter(vul=vul).order_by('timestamp')
-    comments = Comment.objects.filter(vul=vul).order_by('timestamp')
+    comments, more_comments = comment_page(vul.pk)
     comment_form = CommentForm()
     template_name = 'detail_print.html' if 'print' in request.GET else 'detail.html'
 
@@ -252,8 +325,10 @@ def detail_view(request, author, vid):
         'vul': vul,
         'form': form,
         'comment_form': comment_form,
-        'events': events,
+        'events': vul.events,
         'comments': comments,
+        'comments_since': comments[-1].pk if comments else 0,
+        'more_comments': more_comments,
         'is_anonymous': is_anonymous,
         'status_choices': STATUS_CHOICES,
     })
@@ -262,8 +337,6 @@ def detail_view(request, author, vid):
 @require_GET
 @staff_required
 def review_list_view(request, author, status=0):
-    page = request.GET.get('page')
-
     author_choices = (('all', '全部'), ('member', '注册用户'), ('anonymous', '匿名用户'))
     status_choices = (('all', '全部'),) + STATUS_CHOICES
 
@@ -280,18 +353,11 @@ def review_list_view(request, author, status=0):
     else:
         reviews = model.objects.all()
 
-    paginator = Paginator(reviews, 20)
-
-    try:
-        vuls = paginator.page(page)
-    except PageNotAnInteger:
-        vuls = paginator.page(1)
-    except EmptyPage:
-        vuls = paginator.page(paginator.num_pages)
+    paginator = CursorPaginator(reviews, ('-pk',), 20)
 
     data = {
         'author': author,
-        'items': vuls,
+        'items': paginator.page(request.GET),
         'status': status,
         'status_choices': status_choices,
         'author_choices': author_choices,
@@ -339,6 +405,18 @@ def register_view(request, code):
 
 
 @require_GET
+@cached_page('rank', leaderboard_version)
 def rank_view(request):
-    top10 = WhiteHat.objects.filter(public=True).order_by('-reputation')[:10]
-    return render(request, 'rank.html', {'top10': top10})
+    try:
+        limit = max(int(request.GET.get('n', 10)), 1)
+    except ValueError:
+        limit = 10
+
+    department = request.GET.get('department') or None
+    data = {
+        'heroes': page_data(request, lambda: leaderboard(limit, department)),
+        'department': department,
+        'version': leaderboard_version(request),
+        'fragment_timeout': FRAGMENT_TIMEOUT,
+    }
+    return render(request, 'rank.html', data)
@@ -14,3 +14,5 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ujscert.settings")
 
 application = get_wsgi_application()
+
+import ujscert.db  # noqa: E402, connection health checks and metrics for the workers